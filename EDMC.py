@@ -4,16 +4,15 @@
 #
 
 import argparse
-import json
-import requests
 import sys
 from os.path import getmtime
-from time import time, sleep
+from time import time
 from xml.etree import ElementTree
 
 import l10n
 l10n.Translations().install_dummy()
 
+import codec
 import collate
 import companion
 import commodity
@@ -25,6 +24,8 @@ import shipyard
 import eddb
 import stats
 import prefs
+import scheduler
+import transport
 from config import appcmdname, appversion, update_feed, config
 
 
@@ -51,13 +52,20 @@ try:
     parser.add_argument('-t', metavar='FILE', help='write player status to FILE in CSV format')
     parser.add_argument('-d', metavar='FILE', help='write raw JSON data to FILE')
     parser.add_argument('-j', help=argparse.SUPPRESS)	# Import JSON dump
+    parser.add_argument('--record', metavar='FILE', help=argparse.SUPPRESS)	# Record network traffic to a cassette
+    parser.add_argument('--replay', metavar='FILE', help=argparse.SUPPRESS)	# Replay network traffic from a cassette
     args = parser.parse_args()
 
+    if args.record:
+        transport.record(args.record)
+    elif args.replay:
+        transport.replay(args.replay)
+
     if args.version:
         latest = ''
         try:
             # Copied from update.py - probably should refactor
-            r = requests.get(update_feed, timeout = 10)
+            r = transport.get(update_feed)
             feed = ElementTree.fromstring(r.text)
             items = dict([(item.find('enclosure').attrib.get('{http://www.andymatuschak.org/xml-namespaces/sparkle}version'),
                            item.find('title').text) for item in feed.findall('channel/item')])
@@ -71,15 +79,20 @@ try:
         sys.exit(EXIT_SUCCESS)
 
     session = companion.Session()
+    querier = scheduler.Scheduler(session)
     if args.j:
         # Import and collate from JSON dump
-        data = json.load(open(args.j))
+        data = codec.load(open(args.j, 'rb'))
         config.set('querytime', getmtime(args.j))
     else:
         session.login(config.get('username'), config.get('password'))
-        querytime = int(time())
-        data = session.query()
-        config.set('querytime', querytime)
+        wait = querier.next_free(scheduler.MANUAL) - time()
+        if wait >= 1:
+            sys.stderr.write('Waiting %ds since the Companion API was queried recently\n' % wait)
+        data = querier.query(scheduler.MANUAL)	# waits if we've been querying too often
+        config.set('querytime', int(session.profiletime))
+        session.save()	# so that the next run can skip logging in
+        config.save()
 
     # Validation
     if not data.get('commander') or not data['commander'].get('name','').strip():
@@ -99,7 +112,7 @@ try:
     # stuff we can do when not docked
     if args.d:
         with open(args.d, 'wt') as h:
-            h.write(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')).encode('utf-8'))
+            codec.dump(data, h)
     if args.c:
         coriolis.export(data, args.c)
     if args.e:
@@ -145,8 +158,7 @@ try:
 
     if args.s:
         if has_shipyard and not data['lastStarport'].get('ships') and not args.j:
-            sleep(SERVER_RETRY)
-            data = session.query()
+            data = querier.query(scheduler.SHIPYARD, SERVER_RETRY, sections=companion.shipyard_sections)	# want fresh data
         if data['lastStarport'].get('ships'):
             shipyard.export(data, args.s)
         elif has_shipyard:
@@ -4,7 +4,6 @@
 import sys
 from sys import platform
 from functools import partial
-import json
 from os import mkdir
 from os.path import expanduser, isdir, join
 import re
@@ -33,6 +32,7 @@ if platform == 'win32' and getattr(sys, 'frozen', False):
 from l10n import Translations
 Translations().install(config.get('language') or None)
 
+import codec
 import companion
 import commodity
 from commodity import COMMODITY_BPC, COMMODITY_CSV
@@ -43,6 +43,11 @@ import loadout
 import coriolis
 import eddb
 import stats
+import travel
+import docklag
+import scheduler
+import delta
+import model
 import prefs
 import plug
 from hotkey import hotkeymgr
@@ -61,8 +66,11 @@ class AppWindow:
 
     def __init__(self, master):
 
-        self.holdofftime = config.getint('querytime') + companion.holdoff
+        self.dockquery = None		# automatic queries after docking
+        self.shipyardquery = None	# retries for missing shipyard data
         self.session = companion.Session()
+        self.scheduler = scheduler.Scheduler(self.session, master.after)
+        self.delta = delta.Tracker()	# so that exporters only see changes
         self.edsm = edsm.EDSM()
 
         self.w = master
@@ -247,9 +255,16 @@ class AppWindow:
         hotkeymgr.register(self.w, config.getint('hotkey_code'), config.getint('hotkey_mods'))
 
         # Install log monitoring
-        monitor.set_callback('Dock', self.getandsend)
+        monitor.set_callback('Dock', self.dock)
+        monitor.dockdelay = docklag.market.first
         monitor.set_callback('Jump', self.system_change)
+        if plug.wants_position():
+            monitor.set_callback('Position', lambda event, timestamp, system, body, relpos: plug.notify_position_changed(timestamp, system, body, relpos))
         monitor.start(self.w)
+        if monitor.system:
+            self.system['text'] = monitor.system
+            self.station['text'] = not monitor.docked and EDDB.system(monitor.system) and self.STATION_UNDOCKED or ''
+            self.edsm.link(monitor.system)
 
         # First run
         if not config.get('username') or not config.get('password'):
@@ -260,6 +275,7 @@ class AppWindow:
     # callback after the Preferences dialog is applied
     def postprefs(self):
         self.set_labels()	# in case language has changed
+        self.delta.reset()	# in case outputs have changed
         self.login()		# in case credentials gave changed
 
     # set main window labels, e.g. after language change
@@ -322,30 +338,51 @@ class AppWindow:
         else:
             return callback()	# try again
 
-    def getandsend(self, event=None, retrying=False):
+    def getandsend(self, event=None, lane=scheduler.MANUAL):
 
         play_sound = event and event.type=='35' and not config.getint('hotkey_mute')
 
-        if not retrying:
-            if time() < self.holdofftime:	# Was invoked by key while in cooldown
-                self.status['text'] = ''
-                if play_sound and (self.holdofftime-time()) < companion.holdoff*0.75:
-                    hotkeymgr.play_bad()	# Don't play sound in first few seconds to prevent repeats
-                return
-            elif play_sound:
-                hotkeymgr.play_good()
-            self.cmdr['text'] = self.system['text'] = self.station['text'] = ''
-            self.system['image'] = ''
-            self.status['text'] = _('Fetching data...')
-            self.button['state'] = self.theme_button['state'] = tk.DISABLED
-            self.edit_menu.entryconfigure(0, state=tk.DISABLED)	# Copy
-            self.w.update_idletasks()
+        if lane == scheduler.MANUAL and event and time() < self.scheduler.next_free(lane):	# Was invoked by key while in cooldown
+            self.status['text'] = ''
+            if play_sound and time() - self.scheduler.lastfetch > companion.holdoff*0.25:
+                hotkeymgr.play_bad()	# Don't play sound in first few seconds to prevent repeats
+            return
+        elif play_sound:
+            hotkeymgr.play_good()
+        self.cmdr['text'] = self.system['text'] = self.station['text'] = ''
+        self.system['image'] = ''
+        self.status['text'] = _('Fetching data...')
+        self.button['state'] = self.theme_button['state'] = tk.DISABLED
+        self.edit_menu.entryconfigure(0, state=tk.DISABLED)	# Copy
+        self.w.update_idletasks()
+        self.scheduler.submit(lane, partial(self.gotdata, event, lane, False), key='market')
+
+    # callback from scheduler
+    def gotdata(self, event, lane, retrying, query):
+
+        play_sound = event and event.type=='35' and not config.getint('hotkey_mute')
 
         try:
             querytime = int(time())
-            data = self.session.query()
+            data = query()	# always fresh data
             config.set('querytime', querytime)
 
+            if lane == scheduler.DOCK and self.dockquery:
+                # Automatic query after docking - has the Companion API caught up yet?
+                if (data.get('commander') and data['commander'].get('docked') and
+                    data.get('lastStarport') and (data['lastStarport'].get('commodities') or data['lastStarport'].get('modules')) and
+                    (not monitor.system or data.get('lastSystem') and data['lastSystem'].get('name') == monitor.system)):
+                    self.dockquery.fresh(querytime)
+                    self.dockquery = None
+                else:
+                    delay = self.dockquery.stale(querytime)
+                    if delay is not None:
+                        if __debug__:
+                            print 'Stale data after docking - retrying in %.1fs' % delay
+                        self.scheduler.submit(lane, partial(self.gotdata, event, lane, True), delay, key='market')
+                        return	# early exit to avoid starting cooldown count
+                    self.dockquery = None	# give up and report what we got
+
             # Validation
             if not data.get('commander') or not data['commander'].get('name','').strip():
                 self.status['text'] = _("Who are you?!")		# Shouldn't happen
@@ -359,7 +396,7 @@ class AppWindow:
                 if __debug__:	# Recording
                     if not isdir('dump'): mkdir('dump')
                     with open('dump/%s%s.%s.json' % (data['lastSystem']['name'], data['commander'].get('docked') and '.'+data['lastStarport']['name'] or '', strftime('%Y-%m-%dT%H.%M.%S', localtime())), 'wt') as h:
-                        h.write(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')).encode('utf-8'))
+                        codec.dump(data, h)
 
                 self.cmdr['text'] = data.get('commander') and data.get('commander').get('name') or ''
                 self.system['text'] = data.get('lastSystem') and data.get('lastSystem').get('name') or ''
@@ -369,13 +406,24 @@ class AppWindow:
 
                 if data['lastStarport'].get('commodities'):
                     # Fixup anomalies in the commodity data
-                    self.session.fixup(data['lastStarport']['commodities'])
+                    rejected = []
+                    self.session.fixup(data['lastStarport']['commodities'], rejected)
+                    if __debug__:
+                        for x in [x for x in rejected if x.reason != 'unmarketable']:
+                            print 'Skipped "%s" in "%s": %s "%s":"%s"' % (x.name, x.categoryname, x.reason, x.field, x.value)
+                model.compact(data)
+
+                # Only bother exporters with sections that have changed since last time
+                changed = self.delta.changes(data)
+                delivered = None	# all sections
+                if __debug__:
+                    print 'Changed: %s' % (', '.join(sorted(changed)) or 'nothing')
 
                 # stuff we can do when not docked
-                plug.notify_newdata(data)
-                if config.getint('output') & config.OUT_SHIP_EDS:
+                plug.notify_newdata(data, changed)
+                if config.getint('output') & config.OUT_SHIP_EDS and delta.wanted(changed, loadout.sections):
                     loadout.export(data)
-                if config.getint('output') & config.OUT_SHIP_CORIOLIS:
+                if config.getint('output') & config.OUT_SHIP_CORIOLIS and delta.wanted(changed, coriolis.sections):
                     coriolis.export(data)
                 if config.getint('output') & config.OUT_SYS_EDSM:
                     # Silently catch any EDSM errors here so that they don't prevent station update
@@ -395,6 +443,7 @@ class AppWindow:
                     # signal as error because the user might actually be docked but the server hosting the Companion API hasn't caught up
                     if not self.status['text']:
                         self.status['text'] = _("You're not docked at a station!")
+                    delivered = [x for x in delta.SECTIONS if x not in delta.DOCKED]	# station data hasn't been exported
 
                 else:
                     # Finally - the data looks sane and we're docked at a station
@@ -413,11 +462,11 @@ class AppWindow:
 
                     else:
                         if data['lastStarport'].get('commodities'):
-                            if config.getint('output') & config.OUT_MKT_CSV:
+                            if config.getint('output') & config.OUT_MKT_CSV and delta.wanted(changed, commodity.sections):
                                 commodity.export(data, COMMODITY_CSV)
-                            if config.getint('output') & config.OUT_MKT_TD:
+                            if config.getint('output') & config.OUT_MKT_TD and delta.wanted(changed, td.sections):
                                 td.export(data)
-                            if config.getint('output') & config.OUT_MKT_BPC:
+                            if config.getint('output') & config.OUT_MKT_BPC and delta.wanted(changed, commodity.sections):
                                 commodity.export(data, COMMODITY_BPC)
 
                         if config.getint('output') & config.OUT_MKT_EDDN:
@@ -425,18 +474,26 @@ class AppWindow:
                             if not old_status:
                                 self.status['text'] = _('Sending data to EDDN...')
                             self.w.update_idletasks()
-                            eddn.export_commodities(data)
-                            eddn.export_outfitting(data)
+                            if delta.wanted(changed, eddn.commodities_sections):
+                                eddn.export_commodities(data)
+                            if delta.wanted(changed, eddn.outfitting_sections):
+                                eddn.export_outfitting(data)
+                            delay = None
                             if has_shipyard and not data['lastStarport'].get('ships'):
-                                # API is flakey about shipyard info - silently retry if missing (<1s is usually sufficient - 5s for margin).
-                                self.w.after(int(SERVER_RETRY * 1000), self.retry_for_shipyard)
-                            else:
+                                # API is flakey about shipyard info - silently retry if missing, after however long it usually takes.
+                                self.shipyardquery = docklag.DockQuery(docklag.shipyard, monitor.docked and monitor.dockedtime or None)
+                                delay = self.shipyardquery.stale(querytime)	# None if not worth retrying
+                            if delay is not None:
+                                self.scheduler.submit(scheduler.SHIPYARD, self.retry_for_shipyard, delay)
+                            elif delta.wanted(changed, eddn.shipyard_sections):
                                 eddn.export_shipyard(data)
                             if not old_status:
                                 self.status['text'] = ''
 
+                self.delta.update(data, delivered)
+
         except companion.VerificationRequired:
-            return prefs.AuthenticationDialog(self.w, partial(self.verify, self.getandsend))
+            return prefs.AuthenticationDialog(self.w, partial(self.verify, partial(self.getandsend, None, lane)))
 
         # Companion API problem
         except companion.ServerError as e:
@@ -444,7 +501,7 @@ class AppWindow:
                 self.status['text'] = unicode(e)
             else:
                 # Retry once if Companion server is unresponsive
-                self.w.after(int(SERVER_RETRY * 1000), lambda:self.getandsend(event, True))
+                self.scheduler.submit(lane, partial(self.gotdata, event, lane, True), SERVER_RETRY, key='market')
                 return	# early exit to avoid starting cooldown count
 
         except requests.exceptions.ConnectionError as e:
@@ -464,22 +521,42 @@ class AppWindow:
         elif play_sound:
             hotkeymgr.play_bad()
 
-        self.holdofftime = querytime + companion.holdoff
+        if lane == scheduler.DOCK:
+            self.dockquery = None
         self.cooldown()
 
-    def retry_for_shipyard(self):
+    # callback from scheduler
+    def retry_for_shipyard(self, query):
         # Try again to get shipyard data and send to EDDN. Don't report errors if can't get or send the data.
         try:
-            data = self.session.query()
+            querytime = time()
+            data = query(companion.shipyard_sections)
             if __debug__:
                 print 'Retry for shipyard - ' + (data['commander'].get('docked') and (data['lastStarport'].get('ships') and 'Success' or 'Failure') or 'Undocked!')
             if data['commander'].get('docked'):	# might have undocked while we were waiting for retry in which case station data is unreliable
+                if data['lastStarport'].get('ships'):
+                    self.shipyardquery.fresh(querytime)
+                else:
+                    delay = self.shipyardquery.stale(querytime)
+                    if delay is not None:
+                        self.scheduler.submit(scheduler.SHIPYARD, self.retry_for_shipyard, delay)
+                        return
                 eddn.export_shipyard(data)
         except:
             pass
 
+    def dock(self, event):
+        # Called when the netLog says we've docked, after however long the Companion API usually takes to catch up
+        self.dockquery = docklag.DockQuery(docklag.market, monitor.dockedtime)
+        self.getandsend(event, scheduler.DOCK)
+
     def system_change(self, event, timestamp, system, coordinates):
 
+        try:
+            travel.journal.append(timestamp, system, coordinates)
+        except:
+            if __debug__: print_exc()
+
         if self.system['text'] != system:
             self.system['text'] = system
 
@@ -527,8 +604,10 @@ class AppWindow:
         return None
 
     def cooldown(self):
-        if time() < self.holdofftime:
-            self.button['text'] = self.theme_button['text'] = _('cooldown {SS}s').format(SS = int(self.holdofftime - time()))	# Update button in main window
+        if self.scheduler.waiting('market'):
+            pass	# we'll be called again once it's fetched
+        elif time() < self.scheduler.next_free(scheduler.MANUAL):
+            self.button['text'] = self.theme_button['text'] = _('cooldown {SS}s').format(SS = int(self.scheduler.next_free(scheduler.MANUAL) - time()))	# Update button in main window
             self.w.after(1000, self.cooldown)
         else:
             self.button['text'] = self.theme_button['text'] = _('Update')	# Update button in main window
@@ -546,9 +625,12 @@ class AppWindow:
     def save_raw(self):
         self.status['text'] = _('Fetching data...')
         self.w.update_idletasks()
+        self.scheduler.submit(scheduler.STATUS, self.gotraw, maxage=None)
 
+    # callback from scheduler
+    def gotraw(self, query):
         try:
-            data = self.session.query()
+            data = query()
             self.cmdr['text'] = data.get('commander') and data.get('commander').get('name') or ''
             self.status['text'] = ''
             f = tkFileDialog.asksaveasfilename(parent = self.w,
@@ -558,7 +640,7 @@ class AppWindow:
                                                initialfile = '%s%s.%s.json' % (data['lastSystem'].get('name', 'Unknown'), data['commander'].get('docked') and '.'+data['lastStarport'].get('name', 'Unknown') or '', strftime('%Y-%m-%dT%H.%M.%S', localtime())))
             if f:
                 with open(f, 'wt') as h:
-                    h.write(json.dumps(data, ensure_ascii=False, indent=2, sort_keys=True, separators=(',', ': ')).encode('utf-8'))
+                    codec.dump(data, h)
         except companion.VerificationRequired:
             prefs.AuthenticationDialog(self.w, partial(self.verify, self.save_raw))
         except companion.ServerError as e:
@@ -571,6 +653,7 @@ class AppWindow:
         hotkeymgr.unregister()
         if platform!='darwin' or self.w.winfo_rooty()>0:	# http://core.tcl.tk/tk/tktview/c84f660833546b1b84e7
             config.set('geometry', '+{1}+{2}'.format(*self.w.geometry().split('+')))
+        docklag.save()
         config.close()
         self.updater.close()
         self.session.close()
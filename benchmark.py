@@ -0,0 +1,1073 @@
+#!/usr/bin/python
+#
+# Performance benchmarks. Not part of the app.
+#
+
+import argparse
+from functools import partial
+from calendar import timegm
+from datetime import datetime
+import json
+import os
+from os.path import getsize, join
+import math
+import Queue
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time as _time
+from time import localtime, mktime, strptime, time
+
+import netlog
+
+
+# Synthetic netLogs
+
+# A representative sample of what the client writes with VerboseLogging on
+NOISE = [
+    '{%s} Commander Put from 37 to 1 (2)\r\n',
+    '{%s} FDPing: 192.168.1.20:5100 OK rtt=23ms\r\n',
+    '{%s} TalkChannelManager::OnPeerDisconnect 3\r\n',
+    '{%s} RxRoute:5583457290474497 Comp:0[IP4NAT:86.12.34.56:51234,5, ] Comp:1[Relay:2a01:4f8::1:5100, ]\r\n',
+    '{%s} Send   [0x6c8e] 0x3f 1 ConnectionMgr::UpdateTransportStatsRequest\r\n',
+    '{%s} Recv   [0x6c8e] 0x40 12 SessionLogic::RemoteControl\r\n',
+    '{%s} Machines to remove from the session: 1\r\n',
+    '{%s} [Node] PeerManager::Update activePeers=4 pending=0\r\n',
+    '{%s} Matchmaking request completed - 0 results\r\n',
+    '{%s} WrongType 6 GetSafeUniversalAddress requested for non-station\r\n',
+]
+
+SYSTEMS = [
+    ('Shinrarta Dezhra', (55.719, 17.594, 27.156)),
+    ('Sol', (0.0, 0.0, 0.0)),
+    ('Pipe (stem) Sector PI-T c3-5', (12.5, 88.40625, 467.8125)),
+    ('Lave', (75.75, 48.75, 70.75)),
+    ('Achenar', (67.5, -119.46875, 24.84375)),
+]
+
+
+def timestamp(secs):
+    return '%02d:%02d:%02d' % ((secs // 3600) % 24, (secs // 60) % 60, secs % 60)
+
+def jumpline(secs, system, coordinates, context='Supercruise'):
+    return '{%s} System:"%s" StarPos:(%.3f,%.3f,%.3f)ly Body:%d RelPos:(%g,%g,%g)km %s\r\n' % (
+        timestamp(secs), system, coordinates[0], coordinates[1], coordinates[2],
+        random.randint(0, 80), random.uniform(-5, 5), random.uniform(-5, 5), random.uniform(-5, 5), context)
+
+def dockline(secs, status):
+    return '{%s} GetSafeUniversalAddress Station Count 1 moved 0 %s Not Landed\r\n' % (timestamp(secs), status)
+
+def header(now):
+    return '============================================\r\n%s %s  (%s GMT)\r\n============================================\r\n' % (
+        _time.strftime('%y-%m-%d-%H:%M', _time.localtime(now)), _time.tzname[_time.localtime(now).tm_isdst > 0], _time.strftime('%H:%M', _time.gmtime(now)))
+
+def synthetic_netlog(h, size, jump_every=2000):
+    # Write approx size bytes of verbose netLog to file handle h. Returns number of lines written.
+    h.write('============================================\r\n16-10-17-12:00 GMT Daylight Time  (11:00 GMT)\r\n============================================\r\n')
+    written = lines = 0
+    secs = 12 * 60 * 60
+    while written < size:
+        if lines % jump_every == 0:
+            (system, coordinates) = random.choice(SYSTEMS)
+            line = jumpline(secs, system, coordinates)
+        elif lines % jump_every == jump_every // 2:
+            line = dockline(secs, random.choice(['Docked', 'Undocked']))
+        else:
+            line = random.choice(NOISE) % timestamp(secs)
+        h.write(line)
+        written += len(line)
+        lines += 1
+        if lines % 50 == 0:
+            secs += 1
+    return lines
+
+
+# Parser as used by monitor before the single-pass classifier, for comparison
+
+_oldsystemre = re.compile(r'\{(.+)\} System:"(.+)" StarPos:\((.+),(.+),(.+)\)ly.* (\S+)')
+_olddockre = re.compile(r'\{(.+)\} GetSafeUniversalAddress Station Count \d+ moved \d+ (\S+) ([^\r\n]+)')
+
+def oldparse(line):
+    match = _oldsystemre.match(line)
+    if match:
+        (visited, system, x, y, z, context) = match.groups()
+        return (visited, system, (float(x), float(y), float(z)), context)
+    match = _olddockre.match(line)
+    if match:
+        return match.groups()
+    return None
+
+
+# Timestamp conversion as used by monitor before LogClock, for comparison
+
+def oldtime(visited):
+    visited_struct = strptime(visited, '%H:%M:%S')
+    now = localtime()
+    if now.tm_hour == 0 and visited_struct.tm_hour == 23:
+        now = localtime(time()-12*60*60)
+    time_struct = datetime(now.tm_year, now.tm_mon, now.tm_mday, visited_struct.tm_hour, visited_struct.tm_min, visited_struct.tm_sec).timetuple()
+    return mktime(time_struct)
+
+
+def cputime():
+    t = os.times()
+    return t[0] + t[1]
+
+def saveconfig(keys):
+    # The given settings as they are now, for restoreconfig() to put back after a benchmark that changes them
+    from config import config
+    return [(key, config.get(key), config.getint(key)) for key in keys]
+
+def restoreconfig(saved):
+    # Put back the settings from saveconfig(), removing those that weren't set
+    from config import config
+    for (key, val, intval) in saved:
+        if val is not None:
+            config.set(key, val)
+        elif intval:
+            config.set(key, intval)	# integers don't show up in get() on Windows
+        else:
+            config.delete(key)
+
+def run(name, filename, fn):
+    size = getsize(filename)
+    lines = found = 0
+    wall = time()
+    cpu = cputime()
+    with open(filename, 'r') as h:
+        for line in h:
+            lines += 1
+            if fn(line):
+                found += 1
+    cpu = cputime() - cpu
+    wall = time() - wall
+    print '%-8s %10d lines %8d records %12.0f lines/s %8.4f CPU s/MB' % (name, lines, found, lines / wall, cpu / (size / 1048576.0))
+    return found
+
+
+def bench_parse(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = join(tmpdir, 'netLog.1610171200.01.log')
+        with open(filename, 'wb') as h:
+            synthetic_netlog(h, args.size * 1048576)
+        print 'netLog: %d MB' % (getsize(filename) // 1048576)
+        old = run('old', filename, oldparse)
+        new = run('new', filename, netlog.parse)
+        assert old == new, 'Parsers disagree (%d != %d)' % (old, new)
+
+        # Chunked reads with LogTail, as used when following a log
+        wall = time()
+        cpu = cputime()
+        tail = netlog.LogTail(filename)
+        found = len(tail.read())
+        tail.close()
+        cpu = cputime() - cpu
+        wall = time() - wall
+        print '%-8s %10s       %8d records %12.0f MB/s  %8.4f CPU s/MB' % ('tail', '', found, getsize(filename) / 1048576.0 / wall, cpu / (getsize(filename) / 1048576.0))
+        assert found == new, 'Tail disagrees (%d != %d)' % (found, new)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def check_clock():
+    # LogClock edge cases. Simulates a client in London writing a netLog, so changes our timezone while running.
+    def check(header, stamps, expected):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, '============================================\r\n%s\r\n' % header)
+        os.close(fd)
+        try:
+            clock = netlog.LogClock(filename)
+            got = [clock(x) for x in stamps]
+            assert got == expected, '%s: %s != %s' % (header, got, expected)
+        finally:
+            os.unlink(filename)
+    utc = lambda *x: timegm(x)
+    tz = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/London'
+    _time.tzset()
+    try:
+        check('16-06-30-23:58 GMT Daylight Time  (22:58 GMT)', ['23:59:59', '00:00:01', '01:00:00'],	# midnight
+              [utc(2016,6,30,22,59,59), utc(2016,6,30,23,0,1), utc(2016,7,1,0,0,0)])
+        check('16-12-31-23:00 GMT Standard Time  (23:00 GMT)', ['23:59:59', '00:00:00'],		# midnight at year end
+              [utc(2016,12,31,23,59,59), utc(2017,1,1,0,0,0)])
+        check('16-10-30-00:30 GMT Daylight Time  (23:30 GMT)', ['01:30:00', '01:59:59', '01:00:01', '01:30:00', '02:00:00'],	# end of DST
+              [utc(2016,10,30,0,30,0), utc(2016,10,30,0,59,59), utc(2016,10,30,1,0,1), utc(2016,10,30,1,30,0), utc(2016,10,30,2,0,0)])
+        check('16-03-27-00:30 GMT Standard Time  (00:30 GMT)', ['00:59:59', '02:00:00', '03:00:00'],	# start of DST
+              [utc(2016,3,27,0,59,59), utc(2016,3,27,1,0,0), utc(2016,3,27,2,0,0)])
+        check('16-10-30-00:30 Pacific Daylight Time  (07:30 GMT)', ['00:31:00', '23:59:00', '00:00:30'],	# client in another timezone
+              [utc(2016,10,30,7,31,0), utc(2016,10,31,6,59,0), utc(2016,10,31,7,0,30)])
+    finally:
+        if tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = tz
+        _time.tzset()
+    print 'Edge cases OK'
+
+
+def bench_clock(args):
+    check_clock()
+
+    stamps = [timestamp(x) for x in xrange(12*60*60, 12*60*60 + args.count)]
+    for (name, fn) in [('old', oldtime), ('new', netlog.LogClock())]:
+        wall = time()
+        for x in stamps:
+            fn(x)
+        wall = time() - wall
+        print '%-8s %12.0f timestamps/s' % (name, len(stamps) / wall)
+
+
+class NetLogWriter(threading.Thread):
+
+    # Writes a netLog stream into logdir in real time: jumps per minute, noise lines per second,
+    # log rotation every rotate seconds, and client restarts (new log after a pause) every restart seconds.
+
+    def __init__(self, logdir, jumps, noise, rotate, restart):
+        threading.Thread.__init__(self, name='netLog writer')
+        self.daemon = True
+        self.logdir = logdir
+        self.jumps = jumps
+        self.noise = noise
+        self.rotate = rotate
+        self.restart = restart
+        self.written = {}	# system -> time written
+        self.stopping = threading.Event()
+        self.session = 0
+
+    def newlog(self, part):
+        if part == 1:
+            self.session += 1	# Logs from successive sessions must sort after each other
+        name = 'netLog.%s%02d.%02d.log' % (_time.strftime('%y%m%d%H%M', _time.localtime()), self.session % 100, part)
+        h = open(join(self.logdir, name), 'wb', 0)
+        h.write(header(time()))
+        return h
+
+    def run(self):
+        part = 1
+        h = self.newlog(part)
+        nextrotate = nextrestart = started = time()
+        nextjump = started + 1	# give the monitor a chance to start
+        nextrotate += self.rotate or 1e10
+        nextrestart += self.restart or 1e10
+        lines = 0
+        count = 0
+        while not self.stopping.is_set():
+            now = time()
+            secs = int(now - _time.timezone + (_time.localtime(now).tm_isdst and 3600 or 0))
+            if now >= nextrestart:
+                h.close()
+                _time.sleep(2)	# client restarting
+                part = 1
+                h = self.newlog(part)
+                nextrestart = time() + self.restart
+                nextrotate = time() + (self.rotate or 1e10)
+            elif now >= nextrotate:
+                h.close()
+                part += 1
+                h = self.newlog(part)
+                nextrotate = now + self.rotate
+            while lines < (now - started) * self.noise:
+                h.write(random.choice(NOISE) % timestamp(secs))
+                lines += 1
+            if self.jumps and now >= nextjump:
+                count += 1
+                system = 'Bench %d' % count
+                (name, coordinates) = random.choice(SYSTEMS)
+                self.written[system] = time()
+                h.write(jumpline(secs, system, coordinates))
+                nextjump = now + 60.0 / self.jumps
+            _time.sleep(0.01)
+        h.close()
+
+
+class HeadlessRoot:
+
+    # Stands in for Tk. Events generated by the monitor's worker thread are delivered on the caller's thread.
+
+    def __init__(self):
+        self.handlers = {}
+        self.events = Queue.Queue()
+
+    def bind_all(self, sequence, func):
+        self.handlers[sequence] = func
+
+    def event_generate(self, sequence, when=None):
+        self.events.put(sequence)
+
+    def mainloop(self, until):
+        while time() < until:
+            try:
+                sequence = self.events.get(timeout = until - time())
+            except Queue.Empty:
+                return
+            self.handlers[sequence](None)
+
+
+def bench_latency(args):
+    from config import config
+    import monitor
+
+    tmpdir = tempfile.mkdtemp()
+    logdir = join(tmpdir, 'Logs')
+    os.mkdir(logdir)
+    with open(join(tmpdir, 'AppConfig.xml'), 'wt') as h:
+        h.write('<AppConfig>\n</AppConfig>\n')
+
+    # Borrow settings for the duration
+    saved = (config.get('logdir'), config.getint('output'))
+    config.set('logdir', logdir)
+    config.set('output', config.OUT_SYS_EDSM)
+    try:
+        received = {}
+        edlogs = monitor.EDLogs()
+        edlogs.checkpointfile = join(tmpdir, 'netlog.json')
+        if args.poll:
+            edlogs._must_poll = lambda path: True
+        edlogs.set_callback('Jump', lambda event, timestamp, system, coordinates: received.setdefault(system, time()))
+        root = HeadlessRoot()
+        writer = NetLogWriter(logdir, args.jumps, args.noise, args.rotate, args.restart)
+        writer.start()
+        _time.sleep(0.1)	# let the writer create the first log
+        edlogs.start(root)
+
+        cpu = cputime()
+        start = time()
+        root.mainloop(start + args.duration)
+        writer.stopping.set()
+        writer.join()
+        root.mainloop(time() + 2 * (args.poll and monitor.EDLogs._POLL or 1))	# drain
+        cpu = cputime() - cpu
+        thread = edlogs.thread
+        edlogs.stop()
+        thread.join()
+        if edlogs.observer:
+            edlogs.observer.stop()
+            edlogs.observer.join()
+
+        latencies = sorted([received[x] - writer.written[x] for x in writer.written if x in received])
+        missed = len(writer.written) - len(latencies)
+        print '%s: %d jumps, %d missed' % (args.poll and 'Polling' or 'Monitoring', len(writer.written), missed)
+        if latencies:
+            print 'Latency p50 %.3fs p99 %.3fs max %.3fs' % (latencies[len(latencies)//2], latencies[int(len(latencies)*0.99)], latencies[-1])
+        print 'CPU %.1f%% (including the writer)' % (100 * cpu / (time() - start))
+    finally:
+        (logdir, output) = saved
+        if logdir:
+            config.set('logdir', logdir)
+        else:
+            config.delete('logdir')
+        config.set('output', output)
+        shutil.rmtree(tmpdir)
+
+
+def bench_docklag(args):
+    # Simulated dockings with random Companion API lag. Compares the old fixed query 5s after docking
+    # (no retry if stale) with queries scheduled from the learned lag model.
+    import docklag
+
+    def report(name, uploads, queries, stale):
+        uploads.sort()
+        print '%-8s uploaded %5.1f%%  median %5.2fs  p90 %5.2fs  %4.2f queries/dock  %4.2f stale/dock' % (
+            name, 100.0 * len(uploads) / args.dockings, uploads[len(uploads)//2], uploads[int(len(uploads)*0.9)],
+            float(queries) / args.dockings, float(stale) / args.dockings)
+
+    random.seed(1)
+    lags = [random.lognormvariate(math.log(i < args.dockings // 2 and args.median or args.median2), args.sigma) for i in range(args.dockings)]
+
+    uploads = [5 for lag in lags if lag <= 5]
+    report('fixed', uploads, len(lags), len(lags) - len(uploads))
+
+    # Simulated clock, one docking per hour
+    clock = [0]
+    docklag.time = lambda: clock[0]
+    model = docklag.LagModel('bench', 5)
+    uploads = []
+    queries = stale = 0
+    for (i, lag) in enumerate(lags):
+        docked = clock[0] = i * 3600.0
+        query = docklag.DockQuery(model, docked)
+        clock[0] += query.first()
+        while True:
+            queries += 1
+            if clock[0] - docked >= lag:
+                query.fresh(clock[0])
+                uploads.append(clock[0] - docked)
+                break
+            stale += 1
+            delay = query.stale(clock[0])
+            if delay is None:
+                break
+            clock[0] += delay
+    docklag.time = time
+    report('learned', uploads, queries, stale)
+
+
+def bench_json(args):
+    # Decode and re-encode a directory of Companion API dumps with each JSON library installed, and check
+    # that they all give the same results as the standard library. Decodes through codec.loads() as if each
+    # library were the only one installed, so includes its fallback for documents the library can't handle.
+    import codec
+
+    def same(a, b):
+        # Equal, and with the same types all the way down
+        if type(a) in [int, long] and type(b) in [int, long]:
+            return a == b
+        elif type(a) != type(b):
+            return False
+        elif isinstance(a, dict):
+            return sorted([(k, type(k)) for k in a]) == sorted([(k, type(k)) for k in b]) and all([same(v, b[k]) for (k, v) in a.iteritems()])
+        elif isinstance(a, list):
+            return len(a) == len(b) and all([same(x, y) for (x, y) in zip(a, b)])
+        else:
+            return a == b
+
+    try:
+        names = sorted(os.listdir(args.dir))
+    except EnvironmentError as e:
+        raise SystemExit('Can\'t read dumps: %s' % e)
+    files = []
+    for name in names:
+        if name.endswith('.json'):
+            with open(join(args.dir, name), 'rb') as h:
+                files.append(h.read())
+    if not files:
+        raise SystemExit('No dumps in %s' % args.dir)
+    size = sum([len(x) for x in files]) / 1048576.0
+    print '%d dumps, %.1f MB. Using %s to decode and %s to encode' % (len(files), size, codec.decoder, codec.encoder)
+
+    expected = [codec.decoders['json'](x) for x in files]
+    default = codec.decoder
+    try:
+        for name in sorted(codec.decoders):
+            codec.decoder = name
+            wall = time()
+            cpu = cputime()
+            for i in range(args.repeat):
+                results = [codec.loads(x) for x in files]
+            cpu = (cputime() - cpu) / args.repeat
+            wall = (time() - wall) / args.repeat
+            print 'decode %-10s %8.1f MB/s %8.4f CPU s/MB' % (name, size / wall, cpu / size)
+            for (result, want) in zip(results, expected):
+                assert same(result, want), '%s decodes differently' % name
+    finally:
+        codec.decoder = default
+
+    dumps = [codec.encoders['json'](x) for x in expected]
+    for name in sorted(codec.encoders):
+        fn = codec.encoders[name]
+        wall = time()
+        cpu = cputime()
+        for i in range(args.repeat):
+            results = [fn(x) for x in expected]
+        cpu = (cputime() - cpu) / args.repeat
+        wall = (time() - wall) / args.repeat
+        print 'encode %-10s %8.1f MB/s %8.4f CPU s/MB' % (name, size / wall, cpu / size)
+        assert results == dumps, '%s encodes differently' % name
+
+
+def large_profile(fleet, modules):
+    # A docked profile with a fleet of fleet ships each with modules modules
+    import companionstub
+    data = companionstub.generated_profile()
+    module = data['ship']['modules']['MediumHardpoint1']
+    for i in range(fleet):
+        data['ships'][str(i)] = {
+            'id': i, 'name': 'Anaconda', 'value': { 'hull': 142447820, 'modules': 100000000, 'cargo': 0, 'total': 242447820 },
+            'starsystem': { 'id': str(i), 'name': 'System %d' % i, 'systemaddress': str(i) },
+            'station': { 'id': str(i), 'name': 'Station %d' % i },
+            'modules': dict([('Slot%02d' % j, module) for j in range(modules)]),
+        }
+    return data
+
+def objsize(x):
+    # Memory taken by decoded objects, including records from model.py
+    import sys
+    import model
+    if isinstance(x, (dict, model.Record)):
+        return sys.getsizeof(x) + sum([objsize(k) + objsize(v) for (k, v) in x.iteritems()]) + (isinstance(x, model.Record) and x._extra is not None and sys.getsizeof(x._extra) or 0)
+    elif isinstance(x, list):
+        return sys.getsizeof(x) + sum([objsize(v) for v in x])
+    else:
+        return sys.getsizeof(x)
+
+def bench_sections(args):
+    # Selective decoding of a profile with a large fleet, against decoding the lot
+    import codec
+    import companion
+    size = objsize
+
+    def subset(full, sections):
+        result = {}
+        for section in sections:
+            (src, dst) = (full, result)
+            names = section.split('.')
+            for name in names[:-1]:
+                if name not in src: break
+                (src, dst) = (src[name], dst.setdefault(name, {}))
+            else:
+                if names[-1] in src:
+                    dst[names[-1]] = src[names[-1]]
+        return result
+
+    data = large_profile(args.fleet, args.modules)
+    profile = codec.dumps(data)
+    if not args.pretty:
+        profile = json.dumps(data, separators=(',', ':'), sort_keys=True)	# as sent by the server
+    full = codec.loads(profile)
+    print '%d ships x %d modules: %.2f MB profile, %.1f MB decoded' % (args.fleet, args.modules, len(profile) / 1048576.0, size(full) / 1048576.0)
+
+    for (name, sections) in [('full', None),
+                             ('lastSystem', ['lastSystem']),
+                             ('shipyard', companion.shipyard_sections),
+                             ('market', ['commander', 'lastSystem', 'lastStarport']),
+                             ('ships', ['ships'])]:
+        cpu = cputime()
+        for i in range(args.repeat):
+            result = codec.loads(profile, sections)
+        cpu = (cputime() - cpu) / args.repeat
+        assert result == (sections is None and full or subset(full, sections)), '%s decodes differently' % name
+        print '%-10s %8.2f CPU ms %8.2f MB decoded' % (name, cpu * 1000, size(result) / 1048576.0)
+
+
+def bench_delta(args):
+    # Repeated Updates at the same station, exporting the market every time against only when it's changed
+    import codec
+    import commodity
+    import companion
+    import delta
+    import td
+    from config import config
+
+    data = large_profile(args.fleet, args.modules)
+    data['lastStarport']['commodities'] = synthetic_market(args.commodities, 0)
+    companion.Session.fixup.im_func(None, data['lastStarport']['commodities'])
+    data['ship']['fuel'] = { 'main': { 'capacity': 32, 'level': 32 } }
+    profile = codec.dumps(data)
+
+    # What changes between one Update and the next
+    def credits(data):
+        data['commander']['credits'] += 1000
+    def fuel(data):
+        data['ship']['fuel']['main']['level'] = random.randint(0, 32)
+    def prices(data):
+        data['lastStarport']['commodities'][0]['sellPrice'] += 1
+    updates = [None, credits, credits, fuel, None, prices, credits, None] * (args.updates // 8)
+    print '%d commodities, %d ships: %d Updates' % (len(data['lastStarport']['commodities']), len(data['ships']), len(updates))
+
+    def export(data):
+        commodity.export(data, commodity.COMMODITY_CSV)
+        td.export(data)
+        commodity.export(data, commodity.COMMODITY_BPC)
+
+    saved = saveconfig(['outdir'])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config.set('outdir', tmpdir)
+        for name in ['always', 'delta']:
+            tracker = delta.Tracker()
+            exports = 0
+            cpu = cputime()
+            for change in updates:
+                data = codec.loads(profile)
+                if change:
+                    change(data)
+                if name == 'always':
+                    export(data)
+                    exports += 1
+                else:
+                    changed = tracker.changes(data)
+                    if delta.wanted(changed, commodity.sections):
+                        export(data)
+                        exports += 1
+                    tracker.update(data)
+            cpu = cputime() - cpu
+            print '%-6s %4d exports %8.2f CPU ms per Update' % (name, exports, cpu * 1000 / len(updates))
+
+        # Common to both, and the cost of the comparison itself
+        cpu = cputime()
+        for i in range(10):
+            codec.loads(profile)
+        print 'decode    %.2f CPU ms' % ((cputime() - cpu) * 100)
+        (a, b) = (codec.loads(profile), codec.loads(profile))
+        tracker = delta.Tracker()
+        tracker.update(a)
+        cpu = cputime()
+        for i in range(100):
+            changed = tracker.changes(b)
+        assert not changed
+        print 'changes() %.2f CPU ms' % ((cputime() - cpu) * 10)
+    finally:
+        restoreconfig(saved)
+        shutil.rmtree(tmpdir)
+
+
+def bench_model(args):
+    # Memory taken by a market and fleet as dicts and as records, and the cost of making records and of looking up
+    # modules
+    import codec
+    import companion
+    import model
+    import outfitting
+
+    data = large_profile(args.fleet, 0)
+    data['lastStarport']['commodities'] = synthetic_market(args.commodities, 0)
+    profile = codec.dumps(data)
+
+    dicts = codec.loads(profile)
+    oldfixup(dicts['lastStarport']['commodities'])
+    cpu = cputime()
+    records = codec.loads(profile)
+    companion.Session.fixup.im_func(None, records['lastStarport']['commodities'])
+    model.compact(records)
+    cpu = cputime() - cpu
+    assert [x.copy() for x in records['lastStarport']['commodities']] == dicts['lastStarport']['commodities']
+    assert model.plain(records['ships']) == dicts['ships']
+    for (name, a, b) in [('market', dicts['lastStarport']['commodities'], records['lastStarport']['commodities']),
+                         ('fleet', dicts['ships'], records['ships'])]:
+        print '%-7s %6d items  dicts %6.2f MB  records %6.2f MB' % (name, len(a), objsize(a) / 1048576.0, objsize(b) / 1048576.0)
+    print 'decode, fixup and compact %.1f CPU ms' % (cpu * 1000)
+
+    modules = [x['module'] for x in data['ship']['modules'].values()] + data['lastStarport']['modules'].values()
+    for (name, fn) in [('lookup', partial(outfitting.lookup, entitled=False)), ('record', outfitting.lookup_record)]:
+        cpu = cputime()
+        for i in range(args.repeat):
+            for module in modules:
+                fn(module, companion.ship_map)
+        print '%-9s %6.2f CPU us per module' % (name, (cputime() - cpu) * 1000000 / args.repeat / len(modules))
+
+
+def oldfixup(commodities):
+    # Session.fixup before it was rewritten, less its diagnostic prints
+    import numbers
+    from companion import category_map, commodity_map
+    i=0
+    while i<len(commodities):
+        commodity = commodities[i]
+        for thing in ['buyPrice', 'sellPrice', 'demand', 'demandBracket', 'stock', 'stockBracket']:
+            if not isinstance(commodity.get(thing), numbers.Number):
+                break
+        else:
+            if not category_map.get(commodity['categoryname'], True):
+                pass
+            elif not commodity.get('categoryname'):
+                pass
+            elif not commodity.get('name'):
+                pass
+            elif not commodity['demandBracket'] in range(4):
+                pass
+            elif not commodity['stockBracket'] in range(4):
+                pass
+            else:
+                commodity['categoryname'] = category_map.get(commodity['categoryname'], commodity['categoryname'])
+                fixed = commodity_map.get(commodity['name'])
+                if type(fixed) == tuple:
+                    (commodity['categoryname'], commodity['name']) = fixed
+                elif fixed:
+                    commodity['name'] = fixed
+                if not commodity['demandBracket']:
+                    commodity['demand'] = 0
+                if not commodity['stockBracket']:
+                    commodity['stock'] = 0
+                i+=1
+                continue
+        commodities.pop(i)
+    return commodities
+
+def synthetic_market(count, bad):
+    # A market of count commodities, roughly the fraction bad of which have something wrong with them
+    import companion
+    names = sorted(companion.commodity_map.keys())
+    categories = sorted(companion.category_map.keys()) + ['Chemicals', 'Metals', 'Minerals', 'Technology']
+    market = []
+    for i in range(count):
+        commodity = {
+            'name': random.random() < 0.2 and random.choice(names) or u'Commodity %d' % i,
+            'categoryname': random.choice(categories),
+            'buyPrice': random.randint(0, 10000),
+            'sellPrice': random.randint(0, 10000),
+            'demand': random.randint(0, 100000),
+            'demandBracket': random.randint(0, 3),
+            'stock': random.random() * 100000,
+            'stockBracket': random.randint(0, 3),
+        }
+        if random.random() < bad:
+            fault = random.randint(0, 3)
+            if fault == 0:
+                commodity[random.choice(['buyPrice', 'sellPrice', 'demand', 'demandBracket', 'stock', 'stockBracket'])] = ''
+            elif fault == 1:
+                commodity['demandBracket'] = 7
+            elif fault == 2:
+                commodity['name'] = ''
+            else:
+                commodity['categoryname'] = ''
+        market.append(commodity)
+    return market
+
+def bench_fixup(args):
+    import companion
+    fixup = companion.Session.fixup.im_func	# doesn't need a Session
+    random.seed(1)
+    markets = [synthetic_market(args.commodities, args.bad) for i in range(args.markets)]
+    print '%d markets of %d commodities, %.0f%% bad' % (args.markets, args.commodities, args.bad * 100)
+
+    results = {}
+    for (name, fn) in [('old', oldfixup), ('new', lambda market: fixup(None, market))]:
+        data = [[dict(x) for x in market] for market in markets]
+        wall = time()
+        cpu = cputime()
+        for market in data:
+            fn(market)
+        cpu = cputime() - cpu
+        wall = time() - wall
+        print '%-8s %12.0f commodities/s %8.4f CPU s' % (name, args.markets * args.commodities / wall, cpu)
+        results[name] = data
+    assert results['old'] == results['new'], 'Fixups disagree'
+    print 'kept %d of %d' % (sum([len(x) for x in results['new']]), args.markets * args.commodities)
+
+
+def bench_schedule(args):
+    # Simulated play session with dockings, Update button presses and Status dialogs. Compares the old
+    # fixed holdoff after every query with the scheduler, counting dockings whose market gets uploaded.
+    import heapq
+    import companion
+    import docklag
+    from config import config
+    import scheduler
+
+    clock = [0.0]
+    docklag.time = scheduler.time = lambda: clock[0]
+
+    random.seed(1)
+    # (dock time, Companion API lag, undock time)
+    dockings = []
+    t = 60.0
+    while t < args.hours * 3600:
+        stay = random.expovariate(1.0 / args.stay)
+        dockings.append((t, random.lognormvariate(math.log(3), 0.5), t + stay))
+        t += stay + max(30, random.expovariate(1.0 / args.flight))
+    presses = sorted([random.uniform(0, args.hours * 3600) for i in range(int(args.hours * 60 / args.presses))])
+    statuses = sorted([random.uniform(0, args.hours * 3600) for i in range(int(args.hours * 60 / args.status))])
+
+    def docked(t):
+        # The docking in progress at time t, or None
+        for docking in dockings:
+            if docking[0] <= t < docking[2]:
+                return docking
+        return None
+
+    class Session:
+        # Stands in for companion.Session
+        def __init__(self):
+            self.profile = None
+            self.profiletime = 0
+            self.fetches = []
+        def cached(self, maxage=None):
+            return bool(self.profile) and clock[0] - self.profiletime <= (maxage is None and companion.query_ttl or maxage)
+        def query(self, maxage=None, sections=None):
+            if not self.cached(maxage):
+                self.fetches.append(clock[0])
+                docking = docked(clock[0])
+                self.profile = (docking and clock[0] >= docking[0] + docking[1]) and docking or 'stale'
+                self.profiletime = clock[0]
+            return self.profile
+
+    def report(name, session, uploaded):
+        fetches = session.fetches
+        peak = max([len([y for y in fetches if x <= y < x + 60]) for x in fetches] or [0])
+        print '%-8s uploaded %5.1f%% of %d dockings  %5.1f fetches/hour  peak %d in 60s' % (
+            name, 100.0 * len(uploaded) / len(dockings), len(dockings), len(fetches) / float(args.hours), peak)
+
+    # Old: any query holds off the next for companion.holdoff, except retries after docking. Docking or
+    # pressing Update during holdoff does nothing.
+    session = Session()
+    uploaded = set()
+    events = [(t[0] + docklag.LagModel.MIN_DELAY + 4, 'dock', t) for t in dockings] + [(t, 'manual', None) for t in presses] + [(t, 'status', None) for t in statuses]
+    heapq.heapify(events)
+    holdoff = 0
+    model = docklag.LagModel('old', 5)
+    while events:
+        (clock[0], kind, docking) = heapq.heappop(events)
+        if kind == 'status':
+            session.query()
+            continue
+        elif kind in ['dock', 'manual'] and clock[0] < holdoff:
+            continue
+        elif kind == 'dock':
+            query = docklag.DockQuery(model)
+        elif kind == 'retry':
+            query = docking
+        profile = session.query(0)
+        if profile != 'stale':
+            uploaded.add(profile)
+        elif kind != 'manual':
+            delay = query.stale(clock[0])
+            if delay is not None:
+                heapq.heappush(events, (clock[0] + delay, 'retry', query))
+                continue
+        holdoff = clock[0] + companion.holdoff
+    report('old', session, uploaded)
+
+    # Scheduler
+    session = Session()
+    uploaded = set()
+    timers = []
+    count = [0]
+    def after(ms, fn):
+        count[0] += 1
+        heapq.heappush(timers, (clock[0] + ms / 1000.0, count[0], fn))
+    saved = saveconfig(['querybucket', 'querytime'])	# the user's own rate limit
+    try:
+        config.set('querybucket', 0)
+        config.set('querytime', 0)
+        sched = scheduler.Scheduler(session, after)
+        model = docklag.LagModel('new', 5)
+        def gotdata(dockquery, query):
+            profile = query()
+            if profile != 'stale':
+                uploaded.add(profile)
+            elif dockquery:
+                delay = dockquery.stale(clock[0])
+                if delay is not None:
+                    sched.submit(scheduler.DOCK, partial(gotdata, dockquery), delay, key='market')
+        events = [(t[0] + docklag.LagModel.MIN_DELAY + 4, 'dock') for t in dockings] + [(t, 'manual') for t in presses] + [(t, 'status') for t in statuses]
+        events.sort()
+        for (when, kind) in events:
+            while timers and timers[0][0] <= when:
+                (clock[0], n, fn) = heapq.heappop(timers)
+                fn()
+            clock[0] = when
+            if kind == 'dock':
+                sched.submit(scheduler.DOCK, partial(gotdata, docklag.DockQuery(model)), key='market')
+            elif kind == 'manual':
+                if clock[0] >= sched.next_free(scheduler.MANUAL):
+                    sched.submit(scheduler.MANUAL, partial(gotdata, None), key='market')
+            else:
+                sched.submit(scheduler.STATUS, lambda query: query(), maxage=None)
+        while timers:
+            (clock[0], n, fn) = heapq.heappop(timers)
+            fn()
+        report('new', session, uploaded)
+    finally:
+        restoreconfig(saved)
+        docklag.time = scheduler.time = time
+
+
+def bench_companion(args):
+    # Login and profile queries against the stand-in Companion API server, from several threads at once
+    import companion
+    import companionstub
+    import transport
+
+    saved = saveconfig(['loggedin'])	# login() records the stand-in account as logged in
+    server = None
+    try:
+        if args.server:
+            companion.set_server(args.server)
+        else:
+            server = companionstub.Server(latency=args.latency, errors=args.errors, expire=args.expire).start()
+            companion.set_server(server.url)
+
+        latencies = []
+        failures = [0]
+        lock = threading.Lock()
+        def worker():
+            session = companion.Session()
+            session.session.cookies.clear()
+            session.save = lambda: None	# don't touch the real cookie jar
+            session.login('stub@example.com', 'password')
+            for i in range(args.queries):
+                start = time()
+                try:
+                    session.query(0)
+                except Exception:
+                    with lock:
+                        failures[0] += 1
+                with lock:
+                    latencies.append(time() - start)
+
+        threads = [threading.Thread(target=worker) for i in range(args.threads)]
+        wall = time()
+        cpu = cputime()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cpu = cputime() - cpu
+        wall = time() - wall
+        latencies.sort()
+        print '%d threads x %d queries: %.0f queries/s  median %.1fms  p99 %.1fms  %d failed  %.2f CPU ms/query' % (
+            args.threads, args.queries, len(latencies) / wall, latencies[len(latencies)//2] * 1000, latencies[int(len(latencies)*0.99)] * 1000,
+            failures[0], cpu * 1000 / len(latencies))
+        for (host, x) in sorted(transport.metrics().items()):
+            print '%-24s %6d requests %4d errors %4d connections' % (host, x['requests'], x['errors'], x.get('connections', 0))
+        if server:
+            print 'server: %s' % ', '.join(['%s %d' % x for x in sorted(server.counts.items())])
+    finally:
+        restoreconfig(saved)
+        if server:
+            server.stop()
+
+
+def bench_pool(args):
+    # Many commanders' queries from one process, against the stand-in Companion API server
+    import gc
+    import sys
+    import types
+    import companion
+    import companionstub
+    import scheduler
+    import transport
+
+    def size(roots, shared):
+        # MB taken by roots and everything that they refer to, other than shared objects and code
+        seen = set([id(x) for x in shared])
+        todo = list(roots)
+        total = 0
+        while todo:
+            x = todo.pop()
+            if id(x) in seen or isinstance(x, (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)):
+                continue
+            seen.add(id(x))
+            total += sys.getsizeof(x)
+            todo.extend(gc.get_referents(x))
+        return total / 1048576.0
+
+    # Each commander's login state and rate limit
+    keys = [companion.account_key(u'Cmdr %d' % i) for i in range(max(10, args.commanders))]
+    saved = saveconfig(['loggedin_' + x for x in keys] + ['querybucket_' + x for x in keys])
+
+    server = companionstub.Server(latency=args.latency).start()
+    companion.set_server(server.url)
+    cookiedir = tempfile.mkdtemp()
+    sessions = companion.SessionPool(cookiedir)
+    loop = scheduler.Loop()
+    pool = scheduler.Pool(sessions, loop.after)
+    thread = threading.Thread(target=loop.run)
+    thread.start()
+
+    done = Queue.Queue()
+    def gotdata(commander, query):
+        try:
+            query(['commander'])
+            done.put(None)
+        except Exception as e:
+            done.put(e)
+
+    def batch(name, commanders, maxage):
+        wall = time()
+        for commander in commanders:
+            loop.after(0, partial(pool.submit, commander, scheduler.DOCK, partial(gotdata, commander), maxage=maxage))
+        errors = [x for x in [done.get() for commander in commanders] if x]
+        wall = time() - wall
+        # Each commander's logged-in session, including its cached profile, and scheduler, not counting the
+        # connections and event loop that they share
+        roots = [sessions.get(x) for x in sessions.commanders()] + [pool.scheduler(x) for x in sessions.commanders()]
+        mb = size(roots, [transport.transport, transport.noretry, loop, sessions, pool])
+        print '%4d commanders %-7s %6.0f queries/s %3d failed  sessions %.2f MB (%.3f MB per commander)' % (
+            len(sessions.commanders()), name, len(commanders) / wall, len(errors), mb, mb / len(sessions.commanders()))
+
+    try:
+        for target in sorted(set([1, 10, args.commanders])):
+            new = []
+            for i in range(len(sessions.commanders()), target):
+                new.append(u'Cmdr %d' % i)
+                sessions.add(new[-1], 'cmdr%d@example.com' % i, 'password')
+            batch('login', new, 0)
+        batch('cached', sessions.commanders(), None)
+        print 'connections: %s' % ', '.join(['%s %d' % (host, x.get('connections', 0)) for (host, x) in sorted(transport.metrics().items())])
+        print 'server: %s' % ', '.join(['%s %d' % x for x in sorted(server.counts.items())])
+    finally:
+        loop.stop()
+        thread.join()
+        sessions.close()
+        shutil.rmtree(cookiedir)
+        server.stop()
+        restoreconfig(saved)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='EDMC performance benchmarks')
+    subparsers = parser.add_subparsers()
+
+    subparser = subparsers.add_parser('parse', help='netLog line parsing throughput')
+    subparser.add_argument('--size', type=int, default=256, help='size of synthetic netLog in MB (default 256)')
+    subparser.set_defaults(func=bench_parse)
+
+    subparser = subparsers.add_parser('clock', help='netLog timestamp conversion')
+    subparser.add_argument('--count', type=int, default=200000, help='number of timestamps to convert (default 200000)')
+    subparser.set_defaults(func=bench_clock)
+
+    subparser = subparsers.add_parser('latency', help='end-to-end latency from netLog to jump callback')
+    subparser.add_argument('--duration', type=int, default=60, help='seconds to run for (default 60)')
+    subparser.add_argument('--jumps', type=float, default=30, help='jumps per minute (default 30)')
+    subparser.add_argument('--noise', type=float, default=200, help='verbose noise lines per second (default 200)')
+    subparser.add_argument('--rotate', type=float, default=0, help='seconds between log rotations (default never)')
+    subparser.add_argument('--restart', type=float, default=0, help='seconds between client restarts (default never)')
+    subparser.add_argument('--poll', action='store_true', help='force polling rather than file system events')
+    subparser.set_defaults(func=bench_latency)
+
+    subparser = subparsers.add_parser('docklag', help='simulated market queries after docking')
+    subparser.add_argument('--dockings', type=int, default=1000, help='number of dockings (default 1000)')
+    subparser.add_argument('--median', type=float, default=3, help='median Companion API lag in s (default 3)')
+    subparser.add_argument('--median2', type=float, default=1.5, help='median lag for the second half of the dockings (default 1.5)')
+    subparser.add_argument('--sigma', type=float, default=0.5, help='spread of the lognormal lag (default 0.5)')
+    subparser.set_defaults(func=bench_docklag)
+
+    subparser = subparsers.add_parser('companion', help='Companion API queries against the stand-in server')
+    subparser.add_argument('--server', metavar='URL', help='use an already running server (default start one)')
+    subparser.add_argument('--threads', type=int, default=4, help='concurrent sessions (default 4)')
+    subparser.add_argument('--queries', type=int, default=500, help='queries per session (default 500)')
+    subparser.add_argument('--latency', type=float, default=0, help='mean server latency in s (default 0)')
+    subparser.add_argument('--errors', type=float, default=0, help='fraction of queries that fail (default 0)')
+    subparser.add_argument('--expire', type=float, default=0, help='seconds before sessions expire (default never)')
+    subparser.set_defaults(func=bench_companion)
+
+    subparser = subparsers.add_parser('pool', help='many commanders from one process against the stand-in server')
+    subparser.add_argument('--commanders', type=int, default=50, help='number of commanders (default 50)')
+    subparser.add_argument('--latency', type=float, default=0, help='mean server latency in s (default 0)')
+    subparser.set_defaults(func=bench_pool)
+
+    subparser = subparsers.add_parser('schedule', help='simulated Companion API queries over a play session')
+    subparser.add_argument('--hours', type=float, default=100, help='hours of play (default 100)')
+    subparser.add_argument('--stay', type=float, default=90, help='mean time docked in s (default 90)')
+    subparser.add_argument('--flight', type=float, default=120, help='mean time between stations in s (default 120)')
+    subparser.add_argument('--presses', type=float, default=5, help='mean minutes between Update presses (default 5)')
+    subparser.add_argument('--status', type=float, default=20, help='mean minutes between Status dialogs (default 20)')
+    subparser.set_defaults(func=bench_schedule)
+
+    subparser = subparsers.add_parser('fixup', help='Companion API commodity fixup')
+    subparser.add_argument('--commodities', type=int, default=5000, help='commodities per market (default 5000)')
+    subparser.add_argument('--markets', type=int, default=20, help='number of markets (default 20)')
+    subparser.add_argument('--bad', type=float, default=0.2, help='fraction of bad commodities (default 0.2)')
+    subparser.set_defaults(func=bench_fixup)
+
+    subparser = subparsers.add_parser('sections', help='selective decoding of a profile with a large fleet')
+    subparser.add_argument('--fleet', type=int, default=80, help='ships in the fleet (default 80)')
+    subparser.add_argument('--modules', type=int, default=40, help='modules per ship (default 40)')
+    subparser.add_argument('--pretty', action='store_true', help='pretty-printed as in our dumps (default compact, as from the server)')
+    subparser.add_argument('--repeat', type=int, default=50, help='decodes of each kind (default 50)')
+    subparser.set_defaults(func=bench_sections)
+
+    subparser = subparsers.add_parser('delta', help='repeated Updates at the same station')
+    subparser.add_argument('--commodities', type=int, default=1000, help='commodities in the market (default 1000)')
+    subparser.add_argument('--fleet', type=int, default=80, help='ships in the fleet (default 80)')
+    subparser.add_argument('--modules', type=int, default=40, help='modules per ship (default 40)')
+    subparser.add_argument('--updates', type=int, default=40, help='number of Updates (default 40)')
+    subparser.set_defaults(func=bench_delta)
+
+    subparser = subparsers.add_parser('model', help='memory taken by records against dicts')
+    subparser.add_argument('--commodities', type=int, default=5000, help='commodities in the market (default 5000)')
+    subparser.add_argument('--fleet', type=int, default=80, help='ships in the fleet (default 80)')
+    subparser.add_argument('--repeat', type=int, default=2000, help='passes of module lookups (default 2000)')
+    subparser.set_defaults(func=bench_model)
+
+    subparser = subparsers.add_parser('json', help='decoding and encoding of Companion API dumps')
+    subparser.add_argument('dir', nargs='?', default='dump', help='directory of dumps (default dump)')
+    subparser.add_argument('--repeat', type=int, default=3, help='passes over the dumps (default 3)')
+    subparser.set_defaults(func=bench_json)
+
+    args = parser.parse_args()
+    args.func(args)
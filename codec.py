@@ -0,0 +1,205 @@
+#
+# JSON decoding and encoding for Companion API profiles and dumps, using the fastest library installed.
+#
+# Whichever library is used the results are the same as the standard library's json module - strings decode
+# as unicode, floats at full precision, and dumps are written in our usual pretty-printed format as UTF-8.
+#
+
+import json
+from json.decoder import scanstring
+import re
+
+import model
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Format of our dumps, as read back by EDMC.py -j and collate.py
+DUMP_ARGS = { 'ensure_ascii': False, 'indent': 2, 'sort_keys': True, 'separators': (',', ': ') }
+
+
+def _json_loads(s):
+    return json.loads(s)
+
+def _simplejson_loads(s):
+    # simplejson returns str rather than unicode for ASCII strings unless given unicode
+    if isinstance(s, str):
+        s = s.decode('utf-8')
+    return simplejson.loads(s)
+
+def _ujson_loads(s):
+    return ujson.loads(s, precise_float=True)
+
+def _default(obj):
+    # Encode records from model.py as dicts
+    if isinstance(obj, model.Record):
+        return obj.copy()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _json_dumps(data):
+    s = json.dumps(data, default=_default, **DUMP_ARGS)
+    return isinstance(s, unicode) and s.encode('utf-8') or s
+
+def _simplejson_dumps(data):
+    s = simplejson.dumps(data, namedtuple_as_object=False, default=_default, **DUMP_ARGS)
+    return isinstance(s, unicode) and s.encode('utf-8') or s
+
+
+# name -> function for each library that's installed. ujson's float formatting and indentation differ from
+# json's so it's only used for decoding.
+decoders = { 'json': _json_loads }
+encoders = { 'json': _json_dumps }
+if simplejson:
+    decoders['simplejson'] = _simplejson_loads
+    encoders['simplejson'] = _simplejson_dumps
+if ujson:
+    try:
+        ujson.loads('0.1', precise_float=True)
+    except TypeError:
+        _ujson_loads = ujson.loads	# 2.0 and later are always precise and don't take the argument
+    decoders['ujson'] = _ujson_loads
+
+# fastest first
+decoder = [x for x in ['ujson', 'simplejson', 'json'] if x in decoders][0]
+encoder = [x for x in ['simplejson', 'json'] if x in encoders][0]
+
+
+def loads(s, sections=None):
+    # Decode a JSON document given as UTF-8 str or unicode. If sections is given the document must be an object
+    # and only the named members - e.g. ['lastSystem', 'lastStarport.ships'] - are decoded, see select().
+    if sections is not None:
+        return select(s, sections)
+    if decoder == 'json':
+        return json.loads(s)
+    try:
+        return decoders[decoder](s)
+    except:
+        # Let the standard library have a go, so that malformed input and oddities such as integers too big
+        # for ujson behave the same whichever library is installed
+        return json.loads(s)
+
+def load(h, sections=None):
+    return loads(h.read(), sections)
+
+
+# Selective decoding.
+#
+# Walks the top-level object member by member, stepping over everything that wasn't asked for without building
+# it into Python objects and handing each member that was to the fastest decoder as a slice of its own. Stops as
+# soon as everything that was asked for has been found, so that e.g. the commander's fleet, which comes last in
+# the profile, usually isn't even looked at - and when the fleet is what was asked for it's decoded straight
+# through to the end of the profile rather than stepped over first. Strings and numbers decode exactly as with
+# loads().
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+# Up to and including the next bracket that isn't inside a string
+_bracket = re.compile(r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*([{}\[\]])')
+# A whole object or array nested no more than _DEPTH deep, e.g. a module, so that _skip() can step over it in one go
+_DEPTH = 4
+_string = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+_container = r'[{\[][^"{}\[\]]*(?:%s[^"{}\[\]]*)*[}\]]' % _string
+for depth in range(_DEPTH - 1):
+    _container = r'[{\[][^"{}\[\]]*(?:(?:%s|%s)[^"{}\[\]]*)*[}\]]' % (_string, _container)
+_container = re.compile(_container)
+
+def select(s, sections):
+    # Decode only the named sections of a JSON object, as nested dicts laid out as in the full document.
+    # Sections are member names, with '.' separating the names of members of nested objects. Sections that
+    # aren't in the document are left out. Raises ValueError if the parts that were looked at are malformed.
+    tree = {}
+    for section in sections:
+        node = tree
+        names = section.split('.')
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break	# already want all of the parent
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = None	# None means all of it
+    try:
+        return _select(s, _whitespace.match(s).end(), tree, False, len(s.rstrip()) - 1)[0]
+    except (IndexError, AttributeError):
+        raise ValueError('Truncated or malformed JSON document')
+
+def _select(s, i, tree, finish, close=None):
+    # Decode the members named in tree of the object at s[i]. Returns (object, end), where end is None if
+    # everything wanted was found and finish is False, in which case the rest of the object hasn't been read.
+    # close is where the object's closing brace is, if known.
+    if s[i] != '{':
+        raise ValueError('Expecting object at %d' % i)
+    result = {}
+    wanted = len(tree)
+    i = _whitespace.match(s, i+1).end()
+    if s[i] == '}':
+        return (result, i+1)
+    while True:
+        if s[i] != '"':
+            raise ValueError('Expecting property name at %d' % i)
+        (key, i) = scanstring(s, i+1)
+        i = _whitespace.match(s, i).end()
+        if s[i] != ':':
+            raise ValueError('Expecting : delimiter at %d' % i)
+        i = _whitespace.match(s, i+1).end()
+        if key not in tree or key in result:
+            i = _skip(s, i)
+        else:
+            wanted -= 1
+            more = finish or wanted > 0
+            if tree[key] is None:
+                if not more and close is not None and s[i] in '{[':
+                    # If this is the last member it runs up to the closing brace, which saves looking for its end
+                    try:
+                        result[key] = decoders[decoder](s[i:close])
+                        return (result, None)
+                    except:
+                        pass	# not the last member after all
+                start = i
+                i = _skip(s, i)
+                result[key] = loads(s[start:i])
+            else:
+                (result[key], i) = _select(s, i, tree[key], more)
+            if not more:
+                return (result, None)
+        i = _whitespace.match(s, i).end()
+        if s[i] == '}':
+            return (result, i+1)
+        elif s[i] != ',':
+            raise ValueError('Expecting , delimiter at %d' % i)
+        i = _whitespace.match(s, i+1).end()
+
+def _skip(s, i):
+    # Step over the value at s[i], returning its end
+    if s[i] not in '{[':
+        return _decoder.raw_decode(s, i)[1]	# scalars are cheap
+    depth = 0
+    while True:
+        m = _bracket.match(s, i)
+        i = m.end()
+        if m.group(1) in '{[':
+            m = _container.match(s, i-1)
+            if not m:
+                depth += 1	# too deep to take in one go
+            elif depth:
+                i = m.end()
+            else:
+                return m.end()
+        else:
+            depth -= 1
+            if not depth:
+                return i
+
+def dumps(data):
+    # Encode in our dump format, as UTF-8
+    return encoders[encoder](data)
+
+def dump(data, h):
+    h.write(dumps(data))
@@ -4,11 +4,11 @@
 #
 
 import csv
-import json
 import os
 from os.path import exists, isfile
 import sys
 
+import codec
 import companion
 import outfitting
 
@@ -83,7 +83,7 @@ def addmodules(data):
     for key,module in data['lastStarport'].get('modules').iteritems():
         # sanity check
         if int(key) != module.get('id'): raise AssertionError('id: %s!=%s' % (key, module['id']))
-        new = outfitting.lookup(module, companion.ship_map, True)
+        new = outfitting.lookup_record(module, companion.ship_map, True)
         if new:
             old = modules.get(int(key))
             if old:
@@ -168,14 +168,17 @@ if __name__ == "__main__":
         for f in sys.argv[1:]:
             with open(f) as h:
                 print f
-                data = json.load(h)
+                data = codec.load(h)
                 if not data['commander'].get('docked'):
                     print 'Not docked!'
                 elif not data.get('lastStarport'):
                     print 'No starport!'
                 else:
                     if data['lastStarport'].get('commodities'):
-                        session.fixup(data['lastStarport']['commodities'])
+                        rejected = []
+                        session.fixup(data['lastStarport']['commodities'], rejected)
+                        for x in [x for x in rejected if x.reason != 'unmarketable']:
+                            print 'Skipped "%s" in "%s": %s "%s":"%s"' % (x.name, x.categoryname, x.reason, x.field, x.value)
                         addcommodities(data)
                     else:
                         print 'No market'
@@ -8,6 +8,10 @@ import numbers
 import time
 
 from config import config
+import delta
+
+# Sections of the profile used. The commander's name is also used but delta tracks each commander separately.
+sections = [delta.SYSTEM, delta.STATION, delta.MARKET]
 
 bracketmap = { 0: '',
                1: 'Low',
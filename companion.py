@@ -1,24 +1,39 @@
 import requests
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from cookielib import LWPCookieJar
+import hashlib
 import numbers
 import os
 from os.path import dirname, join
 import sys
 from sys import platform
+import threading
 import time
 
 if __debug__:
     from traceback import print_exc
 
+import codec
 from config import config
+import transport
 
 holdoff = 60	# be nice
-timeout = 10	# requests timeout
+query_ttl = 60	# default age up to which a profile can be reused [s]
 
-URL_LOGIN   = 'https://companion.orerve.net/user/login'
-URL_CONFIRM = 'https://companion.orerve.net/user/confirm'
-URL_QUERY   = 'https://companion.orerve.net/profile'
+# Sections of the profile needed to check for and report a station's shipyard
+shipyard_sections = ['commander', 'lastSystem', 'lastStarport.name', 'lastStarport.ships']
+
+SERVER = 'https://companion.orerve.net'
+
+def set_server(url=None):
+    # Talk to a different server, e.g. companionstub.py. Default is the companion_server config setting, if set.
+    global URL_LOGIN, URL_CONFIRM, URL_QUERY
+    url = (url or config.get('companion_server') or SERVER).rstrip('/')
+    URL_LOGIN   = url + '/user/login'
+    URL_CONFIRM = url + '/user/confirm'
+    URL_QUERY   = url + '/profile'
+
+set_server()
 
 
 # Map values reported by the Companion interface to names displayed in-game
@@ -107,6 +122,17 @@ ship_map = {
 }
 
 
+# Lookup tables for Session.fixup()
+_numeric_fields = ['buyPrice', 'sellPrice', 'demand', 'demandBracket', 'stock', 'stockBracket']
+_numeric_types = frozenset([int, long, float, bool])	# fast path for numbers.Number
+_brackets = frozenset(range(4))
+_commodity_fixups = dict([(k, isinstance(v, tuple) and v or (None, v)) for (k, v) in commodity_map.iteritems()])	# name -> (category or None, name)
+
+# A commodity dropped by Session.fixup(). reason is 'invalid', 'missing' or 'unmarketable' and value is the
+# offending field's value.
+Rejected = namedtuple('Rejected', ['name', 'categoryname', 'reason', 'field', 'value'])
+
+
 # Companion API sometimes returns an array as a json array, sometimes as a json object indexed by "int".
 # This seems to depend on whether the there are 'gaps' in the Cmdr's data - i.e. whether the array is sparse.
 # In practice these arrays aren't very sparse so just convert them to lists with any 'gaps' holding None.
@@ -156,9 +182,17 @@ class Session:
 
     STATE_NONE, STATE_INIT, STATE_AUTH, STATE_OK = range(4)
 
-    def __init__(self):
+    def __init__(self, cookiefile=None, authkey='loggedin'):
         self.state = Session.STATE_INIT
         self.credentials = None
+        self.authkey = authkey	# config setting holding a hash of the credentials that our saved cookies are logged in with
+
+        # Last profile fetched, and whether a fetch is in progress
+        self.profile = None	# undecoded, so that each caller gets its own copy to mangle
+        self.profiletime = 0
+        self.fetching = False
+        self.fetched = threading.Condition()
+        self.error = None	# exception raised by the last fetch
 
         # yuck suppress InsecurePlatformWarning
         try:
@@ -170,11 +204,11 @@ class Session:
         if platform=='win32' and getattr(sys, 'frozen', False):
             os.environ['REQUESTS_CA_BUNDLE'] = join(dirname(sys.executable), 'cacert.pem')
 
-        self.session = requests.Session()
+        self.session = transport.Session(retries=False)	# each request counts against the rate limit, so never re-send
         self.session.headers['User-Agent'] = 'Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Mobile/11D257'
-        self.session.cookies = LWPCookieJar(join(config.app_dir, 'cookies.txt'))
+        self.session.cookies = LWPCookieJar(cookiefile or join(config.app_dir, 'cookies.txt'))
         try:
-            self.session.cookies.load()
+            self.session.cookies.load(ignore_discard=True)	# including the session cookie
         except IOError:
             pass
 
@@ -189,12 +223,14 @@ class Session:
 
         if self.credentials == credentials and self.state == Session.STATE_OK:
             return	# already logged in
-        if self.credentials and self.credentials['email'] != credentials['email']:	# changed account
-            self.session.cookies.clear()
-        self.credentials = credentials
+        self.set_credentials(credentials['email'], credentials['password'])
+        if self.state == Session.STATE_INIT and config.get(self.authkey) == self.authhash() and len(self.session.cookies):
+            # Assume that the session in our saved cookies is still good. If it isn't fetch() logs in for real.
+            self.state = Session.STATE_OK
+            return
         self.state = Session.STATE_INIT
         try:
-            r = self.session.post(URL_LOGIN, data = self.credentials, timeout=timeout)
+            r = self.session.post(URL_LOGIN, data = self.credentials)
         except:
             if __debug__: print_exc()
             raise ServerError()
@@ -214,19 +250,89 @@ class Session:
             raise VerificationRequired()
         else:
             self.state = Session.STATE_OK
+            config.set(self.authkey, self.authhash())
+            self.save()	# for next time
             return r.status_code
 
+    def authhash(self):
+        # Identifies our credentials, so that a changed email or password isn't taken as already logged in
+        (email, password) = [isinstance(x, unicode) and x.encode('utf-8') or x for x in [self.credentials['email'], self.credentials['password']]]
+        return hashlib.sha256(email + '\0' + password).hexdigest()
+
+    def set_credentials(self, username, password):
+        # Use these credentials from the next login, which happens on the next query if they've changed
+        credentials = { 'email' : username, 'password' : password }
+        if self.credentials == credentials:
+            return
+        if self.credentials and self.credentials['email'] != credentials['email']:	# changed account
+            self.session.cookies.clear()
+            self.invalidate()
+            config.set(self.authkey, '')
+        self.credentials = credentials
+        self.state = Session.STATE_INIT
+
     def verify(self, code):
         if not code:
             raise VerificationRequired()
-        r = self.session.post(URL_CONFIRM, data = {'code' : code}, timeout=timeout)
+        r = self.session.post(URL_CONFIRM, data = {'code' : code})
         r.raise_for_status()
         if r.url == URL_CONFIRM:	# would have redirected away if success
             raise VerificationRequired()
         self.save()	# Save cookies now for use by command-line app
         self.login()
 
-    def query(self):
+    def query(self, maxage=None, sections=None):
+        # Returns the profile, reusing the last one fetched if it's no older than maxage seconds (default
+        # query_ttl config setting). If a fetch is already in progress then wait for it rather than starting another.
+        # If sections is given then only those parts of the profile are decoded - see codec.select().
+        with self.fetched:
+            if self.fetching:
+                while self.fetching:
+                    self.fetched.wait()
+                if self.error:
+                    raise self.error
+                profile = self.profile
+            elif self.cached(maxage):
+                profile = self.profile
+            else:
+                profile = None
+                self.fetching = True
+                self.error = None
+        if profile:
+            try:
+                return codec.loads(profile, sections)
+            except ValueError:
+                # A selective decode only checks the parts it looks at, so this can be the first time we notice
+                if __debug__: print_exc()
+                self.invalidate()
+                raise ServerError()
+
+        try:
+            (profile, data, fetchtime) = self.fetch(sections)
+        except Exception as e:
+            with self.fetched:
+                self.error = e
+                self.fetching = False
+                self.fetched.notify_all()
+            raise
+        with self.fetched:
+            (self.profile, self.profiletime) = (profile, fetchtime)
+            self.fetching = False
+            self.fetched.notify_all()
+        return data
+
+    def cached(self, maxage=None):
+        # Whether query(maxage) would be answered without a fetch
+        if maxage is None:
+            maxage = config.getint('query_ttl') or query_ttl
+        return bool(self.profile) and time.time() - self.profiletime <= maxage
+
+    def invalidate(self):
+        with self.fetched:
+            self.profile = None
+
+    def fetch(self, sections=None):
+        # Returns (undecoded profile, decoded profile or sections of it, time fetched) from the server
         if self.state == Session.STATE_NONE:
             raise Exception('General error')	# Shouldn't happen - don't bother localizing
         elif self.state == Session.STATE_INIT:
@@ -234,7 +340,8 @@ class Session:
         elif self.state == Session.STATE_AUTH:
             raise VerificationRequired()
         try:
-            r = self.session.get(URL_QUERY, timeout=timeout)
+            fetchtime = time.time()
+            r = self.session.get(URL_QUERY)
         except:
             if __debug__: print_exc()
             raise ServerError()
@@ -243,62 +350,67 @@ class Session:
             self.dump(r)
         if r.status_code == requests.codes.forbidden or r.url == URL_LOGIN:
             # Start again - maybe our session cookie expired?
+            config.set(self.authkey, '')	# so that login() doesn't just assume that we're logged in again
             self.state = Session.STATE_INIT
-            return self.query()
+            return self.fetch(sections)
 
         r.raise_for_status()
         try:
-            data = r.json()
+            data = codec.loads(r.content, sections)
         except:
             self.dump(r)
             raise ServerError()
 
-        return data
+        return (r.content, data, fetchtime)
 
     def save(self):
-        self.session.cookies.save()
+        self.session.cookies.save(ignore_discard=True)
 
     def close(self):
         self.state = Session.STATE_NONE
+        self.invalidate()
         try:
-            self.session.cookies.save()
+            self.save()
             self.session.close()
         except:
             pass
         self.session = None
 
-    # Fixup in-place anomalies in the recieved commodity data
-    def fixup(self, commodities):
-        i=0
-        while i<len(commodities):
-            commodity = commodities[i]
+    # Fixup in-place anomalies in the recieved commodity data, dropping commodities that we can't make sense of.
+    # If rejected is a list then a Rejected is appended to it for each commodity dropped.
+    def fixup(self, commodities, rejected=None):
+        good = []
+        for commodity in commodities:
+            get = commodity.get
 
             # Check all required numeric fields are present and are numeric
             # Catches "demandBracket": "" for some phantom commodites in ED 1.3 - https://github.com/Marginal/EDMarketConnector/issues/2
             # But also see https://github.com/Marginal/EDMarketConnector/issues/32
-            for thing in ['buyPrice', 'sellPrice', 'demand', 'demandBracket', 'stock', 'stockBracket']:
-                if not isinstance(commodity.get(thing), numbers.Number):
-                    if __debug__: print 'Invalid "%s":"%s" (%s) for "%s"' % (thing, commodity.get(thing), type(commodity.get(thing)), commodity.get('name', ''))
+            for thing in _numeric_fields:
+                value = get(thing)
+                if type(value) not in _numeric_types and not isinstance(value, numbers.Number):
+                    reason = ('invalid', thing, value)
                     break
             else:
-                if not category_map.get(commodity['categoryname'], True):	# Check marketable
-                    pass
-                elif not commodity.get('categoryname'):
-                    if __debug__: print 'Missing "categoryname" for "%s"' % commodity.get('name', '')
-                elif not commodity.get('name'):
-                    if __debug__: print 'Missing "name" for a commodity in "%s"' % commodity.get('categoryname', '')
-                elif not commodity['demandBracket'] in range(4):
-                    if __debug__: print 'Invalid "demandBracket":"%s" for "%s"' % (commodity['demandBracket'], commodity['name'])
-                elif not commodity['stockBracket'] in range(4):
-                    if __debug__: print 'Invalid "stockBracket":"%s" for "%s"' % (commodity['stockBracket'], commodity['name'])
+                category = get('categoryname')
+                fixedcategory = category_map.get(category, category)
+                if not category:
+                    reason = ('missing', 'categoryname', category)
+                elif not fixedcategory:	# Check marketable
+                    reason = ('unmarketable', 'categoryname', category)
+                elif not get('name'):
+                    reason = ('missing', 'name', get('name'))
+                elif commodity['demandBracket'] not in _brackets:
+                    reason = ('invalid', 'demandBracket', commodity['demandBracket'])
+                elif commodity['stockBracket'] not in _brackets:
+                    reason = ('invalid', 'stockBracket', commodity['stockBracket'])
                 else:
                     # Rewrite text fields
-                    commodity['categoryname'] = category_map.get(commodity['categoryname'], commodity['categoryname'])
-                    fixed = commodity_map.get(commodity['name'])
-                    if type(fixed) == tuple:
-                        (commodity['categoryname'], commodity['name']) = fixed
-                    elif fixed:
-                        commodity['name'] = fixed
+                    fixed = _commodity_fixups.get(commodity['name'])
+                    if fixed:
+                        (commodity['categoryname'], commodity['name']) = (fixed[0] or fixedcategory, fixed[1])
+                    else:
+                        commodity['categoryname'] = fixedcategory
 
                     # Force demand and stock to zero if their corresponding bracket is zero
                     # Fixes spurious "demand": 1 in ED 1.3
@@ -308,12 +420,14 @@ class Session:
                         commodity['stock'] = 0
 
                     # We're good
-                    i+=1
+                    good.append(commodity)
                     continue
 
             # Skip the commodity
-            commodities.pop(i)
+            if rejected is not None:
+                rejected.append(Rejected(get('name'), get('categoryname'), *reason))
 
+        commodities[:] = good
         return commodities
 
     def dump(self, r):
@@ -322,3 +436,48 @@ class Session:
             print 'URL\t%s' % r.url
             print 'Headers\t%s' % r.headers
             print ('Content:\n%s' % r.text).encode('utf-8')
+
+
+# Sessions for several commanders in one process
+
+def account_key(commander):
+    # Stable name for a commander that's safe to use in file names and config keys
+    return hashlib.sha1(commander.encode('utf-8')).hexdigest()[:16]
+
+class SessionPool:
+
+    # A Session per commander, each with its own credentials, cookie jar and login state. They all share
+    # transport's connection pool, so each extra commander costs little more than their last profile.
+
+    def __init__(self, cookiedir=None):
+        self.cookiedir = cookiedir or config.app_dir
+        self.lock = threading.Lock()
+        self.sessions = {}	# commander -> Session
+
+    def add(self, commander, username, password):
+        # Returns the commander's Session, creating it if necessary. Logs in on its first query.
+        with self.lock:
+            session = self.sessions.get(commander)
+            if not session:
+                key = account_key(commander)
+                session = self.sessions[commander] = Session(join(self.cookiedir, 'cookies-%s.txt' % key), 'loggedin_' + key)
+        session.set_credentials(username, password)
+        return session
+
+    def get(self, commander):
+        with self.lock:
+            return self.sessions.get(commander)
+
+    def commanders(self):
+        with self.lock:
+            return self.sessions.keys()
+
+    def remove(self, commander):
+        with self.lock:
+            session = self.sessions.pop(commander, None)
+        if session:
+            session.close()
+
+    def close(self):
+        for commander in self.commanders():
+            self.remove(commander)
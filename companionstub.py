@@ -0,0 +1,285 @@
+#!/usr/bin/python
+#
+# Stand-in for Frontier's Companion API server, so that the app, EDMC.py and benchmarks can be run offline.
+#
+# Implements /user/login, /user/confirm and /profile with the redirects and session cookie that
+# companion.Session expects, serving recorded dumps or a generated profile. Can add latency, server errors,
+# session expiry (403) and a delay after each docking before the shipyard appears in the profile.
+#
+# Point the app at it by setting the companion_server config setting, e.g. to http://127.0.0.1:8080
+#
+
+import BaseHTTPServer
+import Cookie
+from os import listdir
+from os.path import isdir, join
+import random
+import socket
+import SocketServer
+import threading
+from time import time, sleep
+import urlparse
+import uuid
+
+import codec
+
+
+SESSION_COOKIE = 'CompanionApp'
+MACHINE_COOKIE = 'mid'	# remembers that this machine has been verified
+
+
+def generated_profile(name='Stub Station'):
+    # A plausible docked profile
+    categories = ['Chemicals', 'Consumer Items', 'Foods', 'Metals', 'Minerals', 'Technology', 'NonMarketable']
+    names = ['Hydrogen Fuel', 'Clothing', 'Animalmeat', 'Gold', 'Bauxite', 'Auto Fabricators', 'Drones',
+             'Explosives', 'Consumer Technology', 'Tea', 'Silver', 'Painite', 'Computer Components', 'Basic Narcotics']
+    commodities = []
+    for (i, commodity) in enumerate(names):
+        (demand, stock) = (random.randint(0, 3), random.randint(0, 3))
+        commodities.append({
+            'id': 128049152 + i,
+            'name': commodity,
+            'categoryname': categories[i % len(categories)],
+            'buyPrice': stock and random.randint(50, 10000) or 0,
+            'sellPrice': random.randint(50, 10000),
+            'demand': demand and random.randint(1, 100000) or 0,
+            'demandBracket': demand,
+            'stock': stock and random.randint(1, 100000) or 0,
+            'stockBracket': stock,
+            'meanPrice': 5000,
+        })
+    modules = {}
+    for (i, module) in enumerate(['Hpt_PulseLaser_Fixed_Small', 'Hpt_BeamLaser_Gimbal_Medium', 'Hpt_Railgun_Fixed_Medium',
+                                  'Int_ShieldGenerator_Size2_Class1', 'Int_Engine_Size3_Class5', 'Int_FuelScoop_Size1_Class1',
+                                  'Sidewinder_Armour_Grade1', 'Asp_Armour_Grade3']):
+        modules[str(128049000 + i)] = { 'id': 128049000 + i, 'name': module, 'category': 'weapon', 'cost': random.randint(1000, 1000000), 'sku': None }
+    ships = {
+        'shipyard_list': { 'SideWinder': { 'id': 128049249, 'name': 'SideWinder', 'basevalue': 32000, 'sku': '' },
+                           'Asp': { 'id': 128049303, 'name': 'Asp', 'basevalue': 6661153, 'sku': '' } },
+        'unavailable_list': [],
+    }
+    return {
+        'commander': { 'id': 1, 'name': 'Stub', 'credits': 1000000, 'debt': 0, 'currentShipId': 0, 'docked': True,
+                       'rank': { 'combat': 0, 'trade': 0, 'explore': 0, 'crime': 0, 'service': 0, 'empire': 0, 'federation': 0, 'power': 0, 'cqc': 0 } },
+        'lastSystem': { 'id': '1', 'name': 'Sol', 'faction': 'Federation' },
+        'lastStarport': { 'id': '1', 'name': name, 'faction': 'Federation', 'commodities': commodities, 'modules': modules, 'ships': ships },
+        'ship': { 'id': 0, 'name': 'SideWinder', 'modules': {
+            'MediumHardpoint1': { 'module': { 'id': 128049000, 'name': 'Hpt_PulseLaser_Fixed_Small', 'value': 2200, 'free': False, 'health': 1000000, 'on': True, 'priority': 0 } },
+            'Armour': { 'module': { 'id': 128049006, 'name': 'Sidewinder_Armour_Grade1', 'value': 0, 'free': False, 'health': 1000000, 'on': True, 'priority': 1 } },
+        } },
+        'ships': { '0': { 'id': 0, 'name': 'SideWinder', 'starsystem': { 'id': '1', 'name': 'Sol', 'systemaddress': '1' }, 'station': { 'id': '1', 'name': name } } },
+    }
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    # profiles is a list of decoded profiles to serve in turn, as if the Cmdr is flying from station to station.
+    # latency: mean extra delay per request [s]
+    # errors: fraction of profile requests that fail with a server error
+    # expire: seconds after login that the session cookie stops working and /profile returns 403 (0 = never)
+    # shipyardlag: seconds after each docking before the shipyard appears in the profile
+    # rotate: seconds between dockings, i.e. moving on to the next profile (0 = never)
+    # credentials: (email, password) to accept, or None to accept any
+    # code: verification code required the first time a machine logs in, or None to not require verification
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), profiles=None, latency=0, errors=0, expire=0, shipyardlag=0, rotate=0, credentials=None, code=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.url = 'http://%s:%d' % self.server_address
+        self.profiles = profiles or [generated_profile()]
+        self.latency = latency
+        self.errors = errors
+        self.expire = expire
+        self.shipyardlag = shipyardlag
+        self.rotate = rotate
+        self.credentials = credentials
+        self.code = code
+        self.lock = threading.Lock()
+        self.sessions = {}	# session id -> (login time, verified)
+        self.machines = set()	# verified machine ids
+        self.started = time()
+        self.counts = { 'login': 0, 'confirm': 0, 'profile': 0, 'expired': 0, 'errors': 0 }
+        self.connections = set()
+
+    def start(self):
+        # Serve on a background thread
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Drop connections that clients are keeping alive, and wait for their threads to finish
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        deadline = time() + 1
+        while self.connections and time() < deadline:
+            sleep(0.01)
+
+    def count(self, what):
+        with self.lock:
+            self.counts[what] += 1
+
+    def profile(self):
+        # The profile to serve now, as JSON
+        elapsed = time() - self.started
+        if self.rotate:
+            (docking, since) = divmod(elapsed, self.rotate)
+        else:
+            (docking, since) = (0, elapsed)
+        profile = self.profiles[int(docking) % len(self.profiles)]
+        if since < self.shipyardlag and profile.get('lastStarport', {}).get('ships'):
+            profile = dict(profile, lastStarport=dict(profile['lastStarport']))
+            del profile['lastStarport']['ships']
+        return codec.dumps(profile)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'	# keep-alive
+    wbufsize = -1	# send each response in one go
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def log_message(self, format, *args):
+        pass	# quiet
+
+    def cookies(self):
+        cookies = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        return dict([(k, v.value) for (k, v) in cookies.items()])
+
+    def form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return dict([(k, v[0]) for (k, v) in urlparse.parse_qs(self.rfile.read(length)).items()])
+
+    def reply(self, status, body='', cookies={}, location=None, contenttype='text/html'):
+        self.send_response(status)
+        for (k, v) in cookies.items():
+            self.send_header('Set-Cookie', '%s=%s; Path=/' % (k, v))
+        if location:
+            self.send_header('Location', location)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        if self.server.latency:
+            sleep(random.uniform(0, 2 * self.server.latency))
+
+    def do_GET(self):
+        self.delay()
+        path = urlparse.urlsplit(self.path).path
+        server = self.server
+        if path == '/profile':
+            server.count('profile')
+            cookies = self.cookies()
+            with server.lock:
+                session = server.sessions.get(cookies.get(SESSION_COOKIE))
+                if session and server.expire and time() - session[0] > server.expire:
+                    del server.sessions[cookies[SESSION_COOKIE]]
+                    expired = True
+                else:
+                    expired = False
+            if expired:
+                server.count('expired')
+                self.reply(403, 'Forbidden')
+            elif not session or not session[1]:
+                self.reply(302, location='/user/login')
+            elif random.random() < server.errors:
+                server.count('errors')
+                self.reply(500, 'Internal server error')
+            else:
+                self.reply(200, server.profile(), contenttype='application/json')
+        elif path == '/user/login':
+            self.reply(200, '<form method="post" action="/user/login">Login</form>')
+        elif path == '/user/confirm':
+            self.reply(200, '<form method="post" action="/user/confirm">Verification code</form>')
+        else:
+            self.reply(200, '<html>Stub Companion API</html>')
+
+    def do_POST(self):
+        self.delay()
+        path = urlparse.urlsplit(self.path).path
+        server = self.server
+        form = self.form()
+        cookies = self.cookies()
+        if path == '/user/login':
+            server.count('login')
+            if server.credentials and (form.get('email'), form.get('password')) != server.credentials:
+                self.reply(200, '<form method="post" action="/user/login">Invalid credentials</form>')	# no redirect
+                return
+            session = uuid.uuid4().hex
+            with server.lock:
+                verified = not server.code or cookies.get(MACHINE_COOKIE) in server.machines
+                server.sessions[session] = (time(), verified)
+            self.reply(302, cookies={ SESSION_COOKIE: session }, location=verified and '/' or '/user/confirm')
+        elif path == '/user/confirm':
+            server.count('confirm')
+            session = cookies.get(SESSION_COOKIE)
+            with server.lock:
+                ok = session in server.sessions and form.get('code') == server.code
+                if ok:
+                    machine = uuid.uuid4().hex
+                    server.machines.add(machine)
+                    server.sessions[session] = (server.sessions[session][0], True)
+            if ok:
+                self.reply(302, cookies={ MACHINE_COOKIE: machine }, location='/')
+            else:
+                self.reply(200, '<form method="post" action="/user/confirm">Invalid code</form>')	# no redirect
+        else:
+            self.reply(404, 'Not found')
+
+
+def load_profiles(path):
+    # Decoded profiles from a dump file or a directory of dumps
+    if isdir(path):
+        filenames = [join(path, x) for x in sorted(listdir(path)) if x.endswith('.json')]
+    else:
+        filenames = [path]
+    profiles = []
+    for filename in filenames:
+        with open(filename, 'rb') as h:
+            profiles.append(codec.load(h))
+    return profiles
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stand-in for the Companion API server.')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default 8080)')
+    parser.add_argument('--dumps', metavar='PATH', help='dump file or directory of dumps to serve (default a generated profile)')
+    parser.add_argument('--latency', type=float, default=0, help='mean extra delay per request in s (default 0)')
+    parser.add_argument('--errors', type=float, default=0, help='fraction of profile requests that fail (default 0)')
+    parser.add_argument('--expire', type=float, default=0, help='seconds after login that the session expires (default never)')
+    parser.add_argument('--shipyard-lag', type=float, default=0, help='seconds after docking before the shipyard appears (default 0)')
+    parser.add_argument('--rotate', type=float, default=0, help='seconds between dockings at the next dump (default never)')
+    parser.add_argument('--credentials', nargs=2, metavar=('EMAIL', 'PASSWORD'), help='credentials to accept (default any)')
+    parser.add_argument('--code', help='require this verification code on first login (default no verification)')
+    args = parser.parse_args()
+
+    server = Server(('127.0.0.1', args.port), args.dumps and load_profiles(args.dumps) or None, args.latency, args.errors,
+                    args.expire, args.shipyard_lag, args.rotate, args.credentials and tuple(args.credentials) or None, args.code)
+    print 'Serving on %s - set companion_server to this to use it' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
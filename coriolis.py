@@ -14,6 +14,11 @@ import time
 from config import config
 import outfitting
 import companion
+import delta
+
+
+# Sections of the profile used
+sections = [delta.SHIP, delta.MODULES]
 
 
 # Map API slot names to Coriolis categories
@@ -134,7 +139,7 @@ def export(data, filename=None):
                 loadout['components'][category].append(None)
                 continue
 
-            module = outfitting.lookup(v['module'], ship_map)
+            module = outfitting.lookup_record(v['module'], ship_map)
             if not module:
                 raise AssertionError('Unknown module %s' % v)	# Shouldn't happen
             mass += module.get('mass', 0)
@@ -0,0 +1,102 @@
+#
+# Works out which sections of a Companion API profile have changed since the last one for the same commander,
+# so that exporters and plugins that don't care about what changed can be skipped - e.g. pressing Update again
+# at the same station usually only changes the commander's credits, or nothing at all.
+#
+# Exporters declare the sections that they use, and plugins can do the same with a cmdr_data_sections list.
+#
+
+import cPickle
+
+
+COMMANDER  = 'commander'	# name, credits, rank etc
+SYSTEM     = 'system'
+STATION    = 'station'	# name, faction etc
+SHIP       = 'ship'	# current ship's name, fuel, cargo etc
+MODULES    = 'modules'	# current ship's modules
+MARKET     = 'market'
+OUTFITTING = 'outfitting'
+SHIPYARD   = 'shipyard'
+FLEET      = 'fleet'	# all the commander's ships
+
+# Sections only exported when docked
+DOCKED = [STATION, MARKET, OUTFITTING, SHIPYARD]
+
+# section -> (key, key of its member or None for all of it, keys of members that are separate sections)
+SECTIONS = {
+    COMMANDER:  ('commander',    None,          ()),
+    SYSTEM:     ('lastSystem',   None,          ()),
+    STATION:    ('lastStarport', None,          ('commodities', 'modules', 'ships')),
+    SHIP:       ('ship',         None,          ('modules',)),
+    MODULES:    ('ship',         'modules',     ()),
+    MARKET:     ('lastStarport', 'commodities', ()),
+    OUTFITTING: ('lastStarport', 'modules',     ()),
+    SHIPYARD:   ('lastStarport', 'ships',       ()),
+    FLEET:      ('ships',        None,          ()),
+}
+
+
+def copy(value):
+    # A deep copy of a section. Much quicker than copy.deepcopy().
+    return cPickle.loads(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+
+
+def section(data, name):
+    # The part of the profile that makes up a section, or None if it's missing
+    (key, member, others) = SECTIONS[name]
+    value = data.get(key)
+    if not isinstance(value, dict):
+        return value
+    elif member:
+        return value.get(member)
+    elif others:
+        return dict([(k, v) for (k, v) in value.iteritems() if k not in others])
+    else:
+        return value
+
+
+class Tracker:
+
+    # Remembers the sections of the last profile processed for each commander. Keeps copies, since exporters and
+    # plugins are free to change the profile that they're given. Only sections that have changed are copied, and
+    # they're copied when changes() is called, i.e. before anything else has seen them.
+
+    def __init__(self):
+        self.last = {}	# commander name -> { section: value }
+        self.current = (None, {})	# (profile, { section: copy }) for the sections that changed in the last call to changes()
+
+    def changes(self, data):
+        # The set of sections that differ from those last passed to update() for the same commander, including
+        # sections that haven't been passed to update().
+        last = self.last.get(data['commander']['name'], {})
+        current = {}
+        for name in SECTIONS:
+            value = section(data, name)
+            if name not in last or value != last[name]:
+                current[name] = copy(value)
+        self.current = (data, current)
+        return set(current)
+
+    def update(self, data, sections=None):
+        # Remember the sections (default all) of a profile that has been successfully processed. Call afterwards so
+        # that anything that failed is retried next time.
+        if self.current[0] is not data:
+            self.changes(data)
+        last = self.last.setdefault(data['commander']['name'], {})
+        for name in sections is None and SECTIONS or sections:
+            if name in self.current[1]:
+                last[name] = self.current[1][name]
+        self.current = (None, {})
+
+    def reset(self, commander=None):
+        # Forget the last profile for a commander, or for everyone, e.g. when the output settings change
+        if commander is None:
+            self.last = {}
+        else:
+            self.last.pop(commander, None)
+
+
+def wanted(changed, sections):
+    # Whether a consumer that uses sections needs to see a profile in which changed have changed. Consumers that
+    # don't say what they use (sections None) and unknown changes (changed None) always count.
+    return changed is None or sections is None or bool(changed.intersection(sections))
@@ -0,0 +1,134 @@
+#
+# Learns how long the Companion API takes to catch up after the netLog says we've docked, so that the
+# automatic query can be made as soon as the station's data is likely to be there.
+#
+
+import json
+from os import rename, unlink
+from os.path import exists, join
+from time import time
+
+if __debug__:
+    from traceback import print_exc
+
+from config import config
+import companion
+
+
+FILENAME = 'docklag.json'
+
+
+class LagModel:
+
+    # Each sample is (lo, hi) - the lag after docking was more than lo seconds (when the last stale query was
+    # made, or 0) and at most hi seconds (when the first fresh query was made). Treating each sample as spread
+    # evenly over its range gives a distribution from which to pick query times. Samples where the first
+    # query was already fresh spread down to 0, so the model also learns when the lag gets shorter.
+
+    SAMPLES = 50	# most recent samples to use
+    TARGET = 0.8	# aim for this probability that a query finds fresh data
+    MIN_DELAY = 1	# earliest first query after docking [s]
+    MAX_DELAY = 30	# latest first query after docking [s]
+    MIN_RETRY = 2	# shortest gap between queries [s]
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default	# delay to use until we have some samples
+        self.samples = []
+
+    def record(self, lo, hi):
+        if 0 <= lo < hi <= companion.holdoff:	# else the dock time is unreliable, e.g. read from an old log
+            self.samples = (self.samples + [(lo, hi)])[-self.SAMPLES:]
+
+    def cdf(self, t):
+        # Probability that the lag is at most t
+        return sum([t >= hi and 1.0 or t > lo and (t - lo) / float(hi - lo) or 0.0 for (lo, hi) in self.samples]) / len(self.samples)
+
+    def quantile(self, p):
+        # Smallest lag t such that cdf(t) >= p
+        (lo, hi) = (0.0, float(max([x[1] for x in self.samples])))
+        for i in range(20):
+            mid = (lo + hi) / 2
+            if self.cdf(mid) >= p:
+                hi = mid
+            else:
+                lo = mid
+        return hi
+
+    def first(self, docked):
+        # Seconds from now until the first query after docking at time docked
+        if not self.samples:
+            lag = self.default
+        else:
+            lag = self.quantile(self.TARGET)
+        return min(self.MAX_DELAY, max(self.MIN_DELAY, docked + lag - time()))
+
+    def retry(self, docked, elapsed):
+        # Seconds from now until the next query, given that a query elapsed seconds after docking was stale
+        if not self.samples:
+            lag = elapsed + self.default
+        else:
+            p = self.cdf(elapsed)
+            lag = p < 1 and self.quantile(p + (1 - p) * self.TARGET) or elapsed + self.default	# longer than we've seen
+        return max(self.MIN_RETRY, docked + lag - time())
+
+
+class DockQuery:
+
+    # The automatic queries following one docking. docked is the time of the netLog's Docked line, if known.
+    # Retries are limited in number and must all happen within the holdoff period of the first query.
+
+    RETRIES = 3
+
+    def __init__(self, model, docked=None):
+        self.model = model
+        self.learn = docked is not None
+        self.docked = docked or time()
+        self.started = time()
+        self.lo = 0	# the lag is more than this
+        self.tries = 0
+
+    def first(self):
+        return self.model.first(self.docked)
+
+    def fresh(self, querytime):
+        # The query made at querytime found fresh data
+        if self.learn:
+            self.model.record(self.lo, querytime - self.docked)
+
+    def stale(self, querytime):
+        # The query made at querytime found stale data. Returns seconds to wait before retrying, or None to give up.
+        self.lo = max(self.lo, querytime - self.docked)
+        self.tries += 1
+        delay = self.model.retry(self.docked, self.lo)
+        if self.tries > self.RETRIES or time() + delay > self.started + companion.holdoff:
+            return None
+        return delay
+
+
+market   = LagModel('market', 5)	# until the profile says we're docked with the station's data
+shipyard = LagModel('shipyard', 5)	# until the profile includes the station's ships
+
+
+def load():
+    try:
+        with open(join(config.app_dir, FILENAME), 'rt') as h:
+            samples = json.load(h)
+        for model in [market, shipyard]:
+            model.samples = [tuple(x) for x in samples.get(model.name, [])][-model.SAMPLES:]
+    except:
+        pass
+
+def save():
+    # Write atomically
+    filename = join(config.app_dir, FILENAME)
+    try:
+        with open(filename + '.tmp', 'wt') as h:
+            json.dump(dict([(model.name, model.samples) for model in [market, shipyard]]), h)
+        if exists(filename):
+            unlink(filename)	# Windows can't rename over an existing file
+        rename(filename + '.tmp', filename)
+    except:
+        if __debug__: print_exc()
+
+load()
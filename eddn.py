@@ -10,13 +10,13 @@ import time
 
 from config import applongname, appversion, config
 import companion
+import delta
 import outfitting
+import transport
 
 ### upload = 'http://localhost:8081/upload/'	# testing
 upload = 'http://eddn-gateway.elite-markets.net:8080/upload/'
 
-timeout= 10	# requests timeout
-
 # Map API ship names to EDDN schema names
 # https://raw.githubusercontent.com/jamesremuscat/EDDN/master/schemas/shipyard-v1.0.json
 ship_map = dict(companion.ship_map)
@@ -28,6 +28,11 @@ bracketmap = { 1: 'Low',
                2: 'Med',
                3: 'High', }
 
+# Sections of the profile used by each export
+commodities_sections = [delta.SYSTEM, delta.STATION, delta.MARKET]
+outfitting_sections  = [delta.SYSTEM, delta.STATION, delta.OUTFITTING]
+shipyard_sections    = [delta.SYSTEM, delta.STATION, delta.SHIPYARD]
+
 def send(cmdr, msg):
     msg['header'] = {
         'softwareName'    : '%s [%s]' % (applongname, platform=='darwin' and "Mac OS" or system()),
@@ -36,7 +41,7 @@ def send(cmdr, msg):
     }
     msg['message']['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(config.getint('querytime') or int(time.time())))
 
-    r = requests.post(upload, data=json.dumps(msg), timeout=timeout)
+    r = transport.post(upload, data=json.dumps(msg))
     if __debug__ and r.status_code != requests.codes.ok:
         print 'Status\t%s'  % r.status_code
         print 'URL\t%s'  % r.url
@@ -78,7 +83,7 @@ def export_outfitting(data):
         modules = []
         for v in data['lastStarport'].get('modules', {}).itervalues():
             try:
-                module = outfitting.lookup(v, ship_map)
+                module = outfitting.lookup_record(v, ship_map)
                 if module:
                     modules.append({ k: module[k] for k in schemakeys if k in module })	# just the relevant keys
             except AssertionError as e:
@@ -1,4 +1,3 @@
-import requests
 import threading
 from sys import platform
 import time
@@ -7,13 +6,13 @@ import urllib
 import Tkinter as tk
 
 from config import applongname, appversion, config
+import transport
 
 if __debug__:
     from traceback import print_exc
 
 class EDSM:
 
-    _TIMEOUT = 10
     FAKE = ['CQC', 'Training', 'Destination']	# Fake systems that shouldn't be sent to EDSM
 
     def __init__(self):
@@ -42,7 +41,7 @@ class EDSM:
             self.result = { 'img': EDSM._IMG_KNOWN, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib.quote(system_name), 'done': True, 'uncharted': False }
         else:
             self.result = { 'img': EDSM._IMG_ERROR, 'url': 'https://www.edsm.net/show-system?systemName=%s' % urllib.quote(system_name), 'done': True, 'uncharted': False }
-            r = requests.get('https://www.edsm.net/api-v1/system?sysname=%s&coords=1&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)), timeout=EDSM._TIMEOUT)
+            r = transport.get('https://www.edsm.net/api-v1/system?sysname=%s&coords=1&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)))
             r.raise_for_status()
             data = r.json()
 
@@ -77,7 +76,7 @@ class EDSM:
 
     def worker(self, system_name, result):
         try:
-            r = requests.get('https://www.edsm.net/api-v1/system?sysname=%s&coords=1&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)), timeout=EDSM._TIMEOUT)
+            r = transport.get('https://www.edsm.net/api-v1/system?sysname=%s&coords=1&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)))
             r.raise_for_status()
             data = r.json()
 
@@ -86,7 +85,7 @@ class EDSM:
                 result['img'] = EDSM._IMG_NEW
                 result['uncharted'] = True
                 result['done'] = True	# give feedback immediately
-                requests.get('https://www.edsm.net/api-v1/url?sysname=%s&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)), timeout=EDSM._TIMEOUT)	# creates system
+                transport.get('https://www.edsm.net/api-v1/url?sysname=%s&fromSoftware=%s&fromSoftwareVersion=%s' % (urllib.quote(system_name), urllib.quote(applongname), urllib.quote(appversion)))	# creates system
             elif data.get('coords'):
                 result['img'] = EDSM._IMG_KNOWN
                 result['done'] = True
@@ -127,7 +126,7 @@ def writelog(timestamp, system, edsmlookupfn, coordinates=None):
         )
         if coordinates:
             url += '&x=%.3f&y=%.3f&z=%.3f' % coordinates
-        r = requests.get(url, timeout=EDSM._TIMEOUT)
+        r = transport.get(url)
         r.raise_for_status()
         reply = r.json()
         (msgnum, msg) = reply['msgnum'], reply['msg']
@@ -10,6 +10,11 @@ import time
 from config import config
 import outfitting
 import companion
+import delta
+
+
+# Sections of the profile used
+sections = [delta.SHIP, delta.MODULES]
 
 
 # Map API ship names to E:D Shipyard ship names
@@ -64,7 +69,7 @@ def export(data, filename=None):
         try:
             if not v: continue
 
-            module = outfitting.lookup(v['module'], ship_map)
+            module = outfitting.lookup_record(v['module'], ship_map)
             if not module: continue
 
             cr = class_rating(module)
@@ -0,0 +1,245 @@
+#
+# Compact records for the things that there are lots of in a Companion API profile - commodities, modules and the
+# commander's fleet - so that the profiles that we hang on to, e.g. in delta.Tracker, take less memory.
+#
+# Fields are attributes named as in the profile, with a trailing underscore where that would be a Python keyword
+# (e.g. Module.class_). Members that aren't fields are kept in an overflow dict. Records also have the dict interface,
+# so code written for the raw profile keeps working, they pickle, and codec encodes them as dicts. But they aren't
+# dicts, so plugins get plain() copies unless they ask for records - see plug.notify_newdata().
+#
+# Unlike the rest of the app these are new-style classes, since old-style classes don't support __slots__.
+#
+
+from keyword import iskeyword
+
+_missing = object()
+
+def _attr(field):
+    return iskeyword(field) and field + '_' or field
+
+
+class _RecordType(type):
+
+    # Gives each record class a slot for each of its fields
+
+    def __new__(meta, name, bases, namespace):
+        fields = namespace.get('fields', ())
+        namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + tuple([_attr(x) for x in fields])
+        namespace['attrs'] = dict([(x, _attr(x)) for x in fields])
+        return type.__new__(meta, name, bases, namespace)
+
+
+class Record(object):
+
+    __metaclass__ = _RecordType
+    __slots__ = ('_extra',)	# members that aren't fields
+    __hash__ = None	# like dict
+
+    fields = ()
+    readonly = False	# records that are shared, e.g. from a cache, can't be changed
+
+    def __init__(self, members):
+        extra = None
+        for (key, value) in members.iteritems():
+            attr = self.attrs.get(key)
+            if attr:
+                object.__setattr__(self, attr, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        object.__setattr__(self, '_extra', extra)
+
+    def __setattr__(self, attr, value):
+        if self.readonly:
+            raise TypeError('%s is read-only' % type(self).__name__)
+        object.__setattr__(self, attr, value)
+
+    def __delattr__(self, attr):
+        if self.readonly:
+            raise TypeError('%s is read-only' % type(self).__name__)
+        object.__delattr__(self, attr)
+
+    def __reduce__(self):
+        # Pickle, and copy, as the members - old pickle protocols can't handle __slots__
+        return (type(self), (self.copy(),))
+
+    # dict interface
+
+    def __getitem__(self, key):
+        attr = self.attrs.get(key)
+        if attr:
+            try:
+                return getattr(self, attr)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        attr = self.attrs.get(key)
+        if attr:
+            setattr(self, attr, value)
+        elif self.readonly:
+            raise TypeError('%s is read-only' % type(self).__name__)
+        else:
+            if self._extra is None:
+                object.__setattr__(self, '_extra', {})
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        attr = self.attrs.get(key)
+        if attr:
+            if not hasattr(self, attr):
+                raise KeyError(key)
+            delattr(self, attr)
+        elif self.readonly:
+            raise TypeError('%s is read-only' % type(self).__name__)
+        elif self._extra and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        attr = self.attrs.get(key)
+        if attr:
+            return hasattr(self, attr)
+        else:
+            return bool(self._extra) and key in self._extra
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, default=_missing):
+        if key not in self:
+            if default is _missing:
+                raise KeyError(key)
+            return default
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        keys = self.keys()
+        if not keys:
+            raise KeyError('popitem(): %s is empty' % type(self).__name__)
+        return (keys[0], self.pop(keys[0]))
+
+    def update(self, other=(), **kwargs):
+        for (key, value) in hasattr(other, 'keys') and [(k, other[k]) for k in other.keys()] or other:
+            self[key] = value
+        for (key, value) in kwargs.iteritems():
+            self[key] = value
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+    def keys(self):
+        return [x for x in self.fields if hasattr(self, self.attrs[x])] + (self._extra and self._extra.keys() or [])
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def items(self):
+        return [(x, self[x]) for x in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def copy(self):
+        return dict(self.items())	# as a plain dict, like dict.copy()
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return all([getattr(self, x, _missing) == getattr(other, x, _missing) for x in self.__slots__]) and self._extra == other._extra
+        elif isinstance(other, (Record, dict)):
+            return self.copy() == dict(other.items())
+        else:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result is NotImplemented and result or not result
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.copy())
+
+    @classmethod
+    def fromkeys(cls, keys, value=None):
+        return cls(dict.fromkeys(keys, value))
+
+
+class Commodity(Record):
+
+    # A commodity, after companion.Session.fixup()
+
+    fields = ('id', 'name', 'categoryname', 'buyPrice', 'sellPrice', 'meanPrice', 'demand', 'demandBracket',
+              'stock', 'stockBracket')
+
+
+class Module(Record):
+
+    # A module as described by outfitting.lookup_record(). Shared between lookups, so read-only.
+
+    fields = ('id', 'symbol', 'category', 'name', 'mount', 'guidance', 'ship', 'class', 'rating', 'enabled',
+              'priority', 'entitlement', 'mass', 'optmass', 'maxfuel', 'fuelmul', 'fuelpower')
+    readonly = True
+
+
+class Ship(Record):
+
+    # A ship in the commander's fleet
+
+    fields = ('id', 'name', 'value', 'free', 'station', 'starsystem', 'modules')
+
+
+def compact(data):
+    # Replace the commodities and the commander's fleet in a profile with records, in place. Call after fixing up
+    # the commodities.
+    station = data.get('lastStarport')
+    commodities = isinstance(station, dict) and station.get('commodities')
+    if isinstance(commodities, list):
+        commodities[:] = [isinstance(x, dict) and Commodity(x) or x for x in commodities]
+    ships = data.get('ships')
+    if isinstance(ships, dict):
+        for (key, ship) in ships.iteritems():
+            if isinstance(ship, dict):
+                ships[key] = Ship(ship)
+    elif isinstance(ships, list):
+        for (i, ship) in enumerate(ships):
+            if isinstance(ship, dict):
+                ships[i] = Ship(ship)
+
+
+def plain(thing):
+    # A copy of a profile or part of one with records replaced by dicts, e.g. for modules that expect real dicts
+    if isinstance(thing, (Record, dict)):
+        return dict([(k, plain(v)) for (k, v) in thing.iteritems()])
+    elif isinstance(thing, list):
+        return [plain(x) for x in thing]
+    else:
+        return thing
@@ -1,18 +1,22 @@
 import atexit
+from collections import namedtuple
+import json
+import Queue
 import re
 import threading
-from os import listdir, pardir, rename, unlink, SEEK_SET, SEEK_CUR, SEEK_END
-from os.path import basename, exists, isdir, isfile, join
+from os import listdir, pardir, rename, stat, unlink
+from os.path import basename, dirname, exists, isdir, isfile, join, normpath, realpath
 from platform import machine
 import sys
 from sys import platform
-from time import strptime, localtime, mktime, sleep, time
-from datetime import datetime
+from time import sleep, time
 
 if __debug__:
     from traceback import print_exc
 
 from config import config
+import netlog
+from netlog import LogClock
 
 
 if platform=='darwin':
@@ -53,13 +57,66 @@ elif platform=='win32':
     RegEnumKeyEx.argtypes = [HKEY, DWORD, LPWSTR, ctypes.POINTER(DWORD), ctypes.POINTER(DWORD), LPWSTR, ctypes.POINTER(DWORD), ctypes.POINTER(FILETIME)]
 
 else:
-    # Linux's inotify doesn't work over CIFS or NFS, so poll
-    FileSystemEventHandler = object	# dummy
+    try:
+        from watchdog.observers import Observer		# inotify
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        Observer = None
+        FileSystemEventHandler = object	# dummy
+
+
+_observer = None
+
+def shared_observer():
+    # One watchdog observer (and so one inotify instance and one thread) for all the logdirs we watch
+    global _observer
+    if not _observer:
+        _observer = Observer()
+        _observer.daemon = True
+        _observer.start()
+        atexit.register(_observer.stop)
+    return _observer
+
+
+def load_checkpoint(filename):
+    # Returns (logfile, inode, offset) as saved by a previous run, or None
+    try:
+        with open(filename, 'rt') as h:
+            checkpoint = json.load(h)
+        return (checkpoint['logfile'], checkpoint['inode'], checkpoint['offset'])
+    except:
+        return None
+
+def save_checkpoint(filename, position):
+    (logfile, inode, offset) = position
+    try:
+        tmp = filename + '.tmp'
+        with open(tmp, 'wt') as h:
+            json.dump({ 'logfile': logfile, 'inode': inode, 'offset': offset }, h)
+        if exists(filename):
+            unlink(filename)	# Windows can't rename over an existing file
+        rename(tmp, filename)
+    except:
+        if __debug__: print_exc()
+
+
+# Events generated by EDLogs.events(). timestamp is UTC epoch seconds. checkpoint is (logfile, inode, offset)
+# just after the event, and can be passed back to events() to carry on from there.
+Jump   = namedtuple('Jump',   ['timestamp', 'system', 'coordinates', 'checkpoint'])
+Dock   = namedtuple('Dock',   ['timestamp', 'checkpoint'])
+Undock = namedtuple('Undock', ['timestamp', 'checkpoint'])
+# Movement within the current system, with VerboseLogging. body is the id of the nearest body and relpos is
+# (x, y, z) relative to it in km.
+Position = namedtuple('Position', ['timestamp', 'system', 'body', 'relpos', 'checkpoint'])
 
 
 class EDLogs(FileSystemEventHandler):
 
     _POLL = 5		# New system gets posted to log file before hyperspace ends, so don't need to poll too often
+    _POLL_MAX = 60	# Longest interval between polls when the client isn't writing to the log
+    _IDLE = 5*60	# Back off polling after the log hasn't been written for this long
+    _MAX_JUMPS = 1000	# Jumps waiting to be handled by the main thread before the worker blocks
+    _POSITION_INTERVAL = 1000	# Default ms between Position callbacks
 
     def __init__(self):
         FileSystemEventHandler.__init__(self)	# futureproofing - not need for current version of watchdog
@@ -70,8 +127,31 @@ class EDLogs(FileSystemEventHandler):
         self.observer = None
         self.observed = None
         self.thread = None
-        self.callbacks = { 'Jump': None, 'Dock': None }
-        self.last_event = None	# for communicating the Jump event
+        self.generation = 0	# incremented whenever monitoring stops, so that events() know to stop too
+        self.changes = 0	# incremented by watchdog callbacks when the log is written
+        self.changed = threading.Condition()
+        self.docktimer = None
+        self.dockedtime = None	# UTC time of the last Docked line
+        self.dockdelay = None	# Function giving seconds after the Docked line at time t to wait before the Dock callback
+        self.callbacks = { 'Jump': None, 'Dock': None, 'Position': None }
+        self.jumps = Queue.Queue(self._MAX_JUMPS)	# for communicating Jump events, oldest first
+        self.jumps_lock = threading.Lock()
+        self.jumps_pending = False	# Whether a <<MonitorJump>> event has been generated but not yet handled
+        self.latestposition = None	# Only the latest Position is passed on, at most once every position_interval ms
+        self.position_pending = False	# Whether a <<MonitorPosition>> event has been generated but not yet handled
+        self.positiontimer = None
+        self.positiontime = 0
+
+        # Current state as of the last line read
+        self.system = None
+        self.coordinates = None
+        self.docked = False
+
+        # Polling statistics
+        self.pollstats = { 'polls': 0, 'polls saved': 0, 'listdirs': 0, 'listdirs saved': 0 }
+        self.checkpointfile = join(config.app_dir, 'netlog.json')
+        self.position = None	# (logfile, inode, offset) up to which we've processed the log
+        atexit.register(self.save_checkpoint)
 
     def logging_enabled_in_file(self, appconf):
         if not isfile(appconf):
@@ -122,7 +202,9 @@ class EDLogs(FileSystemEventHandler):
         if name in self.callbacks:
             self.callbacks[name] = callback
 
-    def start(self, root):
+    def start(self, root=None):
+        # Start monitoring. If root is supplied then Jump and Dock callbacks are called from its Tk main loop,
+        # otherwise just set up to follow the logs with events().
         self.root = root
         logdir = config.get('logdir') or self.logdir
         if not self.is_valid_logdir(logdir):
@@ -137,36 +219,35 @@ class EDLogs(FileSystemEventHandler):
             # verbose logging reduces likelihood that Docked/Undocked messages will be delayed
             self._enable_logging(self.currentdir)
 
-        self.root.bind_all('<<MonitorJump>>', self.jump)	# user-generated
-        self.root.bind_all('<<MonitorDock>>', self.dock)	# user-generated
-
         # Set up a watchog observer. This is low overhead so is left running irrespective of whether monitoring is desired.
-        # File system events are unreliable/non-existent over network drives on Linux.
-        # We can't easily tell whether a path points to a network drive, so assume
-        # any non-standard logdir might be on a network drive and poll instead.
-        polling = bool(config.get('logdir')) and platform != 'win32'
+        # File system events are unreliable/non-existent over network drives, so poll instead.
+        polling = self._must_poll(logdir)
         if not polling and not self.observer:
-            self.observer = Observer()
-            self.observer.daemon = True
-            self.observer.start()
-            atexit.register(self.observer.stop)
+            self.observer = shared_observer()
 
         if not self.observed and not polling:
             self.observed = self.observer.schedule(self, self.currentdir)
 
-        # Latest pre-existing logfile - e.g. if E:D is already running. Assumes logs sort alphabetically.
-        try:
-            logfiles = sorted([x for x in listdir(logdir) if x.startswith('netLog.')])
-            self.logfile = logfiles and join(logdir, logfiles[-1]) or None
-        except:
-            self.logfile = None
+        # Latest pre-existing logfile - e.g. if E:D is already running.
+        self.logfile = self.latest(logdir)
 
         if __debug__:
             print '%s "%s"' % (polling and 'Polling' or 'Monitoring', logdir)
             print 'Start logfile "%s"' % self.logfile
 
-        if not self.running():
-            self.thread = threading.Thread(target = self.worker, name = 'netLog worker')
+        if root and not self.running():
+            self.root.bind_all('<<MonitorJump>>', self.jump)	# user-generated
+            self.root.bind_all('<<MonitorDock>>', self.dock)	# user-generated
+            self.root.bind_all('<<MonitorPosition>>', self.moved)	# user-generated
+
+            # Recover current state from the log so far, so that we don't have to wait for the next jump to know where we are
+            backlog = self.resume(self.currentdir, self.load_checkpoint())
+            (jump, dock) = backlog and netlog.last_state(*backlog[0]) or (None, None)
+            self.system = jump and jump.system
+            self.coordinates = jump and jump.coordinates
+            self.docked = bool(dock) and dock.status == 'Docked'
+
+            self.thread = threading.Thread(target = self.worker, name = 'netLog worker', args = (backlog and (backlog[0][0], 0, backlog[0][1]), (jump, dock)))
             self.thread.daemon = True
             self.thread.start()
 
@@ -174,13 +255,31 @@ class EDLogs(FileSystemEventHandler):
 
     def stop(self):
         if __debug__:
-            print 'Stopping monitoring'
+            print 'Stopping monitoring', self.pollstats
         self.currentdir = None
         if self.observed:
+            self.observer.unschedule(self.observed)
             self.observed = None
-            self.observer.unschedule_all()
         self.thread = None	# Orphan the worker thread - will terminate at next poll
-        self.last_event = None
+        if self.docktimer:
+            self.docktimer.cancel()
+            self.docktimer = None
+        with self.jumps_lock:
+            if self.positiontimer:
+                self.positiontimer.cancel()
+                self.positiontimer = None
+            self.position_pending = False
+            self.latestposition = None
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+        (jumps, self.jumps) = (self.jumps, Queue.Queue(self._MAX_JUMPS))	# Discard unhandled jumps
+        while True:
+            try:
+                jumps.get_nowait()	# wakes the worker if it's blocked in post_jump()
+            except Queue.Empty:
+                break
+        self.save_checkpoint()
 
     def running(self):
         return self.thread and self.thread.is_alive()
@@ -189,117 +288,204 @@ class EDLogs(FileSystemEventHandler):
         # watchdog callback, e.g. client (re)started.
         if not event.is_directory and basename(event.src_path).startswith('netLog.'):
             self.logfile = event.src_path
+            self.notify()
 
-    def worker(self):
-        # Tk isn't thread-safe in general.
-        # event_generate() is the only safe way to poke the main thread from this thread:
-        # https://mail.python.org/pipermail/tkinter-discuss/2013-November/003522.html
+    def on_modified(self, event):
+        # watchdog callback, e.g. client wrote to the log.
+        if not event.is_directory and basename(event.src_path).startswith('netLog.'):
+            self.notify()
 
-        # e.g.:
-        #   "{18:00:41} System:"Shinrarta Dezhra" StarPos:(55.719,17.594,27.156)ly  NormalFlight\r\n"
-        # or with verboseLogging:
-        #   "{17:20:18} System:"Shinrarta Dezhra" StarPos:(55.719,17.594,27.156)ly Body:69 RelPos:(0.334918,1.20754,1.23625)km NormalFlight\r\n"
-        # or:
-        #   "... Supercruise\r\n"
-        # Note that system name may contain parantheses, e.g. "Pipe (stem) Sector PI-T c3-5".
-        regexp = re.compile(r'\{(.+)\} System:"(.+)" StarPos:\((.+),(.+),(.+)\)ly.* (\S+)')	# (localtime, system, x, y, z, context)
-
-        # e.g.:
-        #   "{14:42:11} GetSafeUniversalAddress Station Count 1 moved 0 Docked Not Landed\r\n"
-        # or:
-        #   "... Undocked Landed\r\n"
-        # Don't use the simpler "Commander Put ..." message since its more likely to be delayed.
-        dockre = re.compile(r'\{(.+)\} GetSafeUniversalAddress Station Count \d+ moved \d+ (\S+) ([^\r\n]+)')	# (localtime, docked_status, landed_status)
-
-        docked = False	# Whether we're docked
-        updated = False	# Whether we've sent an update since we docked
-
-        # Seek to the end of the latest log file
-        logfile = self.logfile
-        if logfile:
-            loghandle = open(logfile, 'r')
-            loghandle.seek(0, SEEK_END)	# seek to EOF
-        else:
-            loghandle = None
+    def notify(self):
+        with self.changed:
+            self.changes += 1
+            self.changed.notify_all()
 
-        while True:
+    def load_checkpoint(self):
+        return load_checkpoint(self.checkpointfile)
 
-            if docked and not updated and not config.getint('output') & config.OUT_MKT_MANUAL:
-                self.root.event_generate('<<MonitorDock>>', when="tail")
-                updated = True
-                if __debug__:
-                    print "%s :\t%s %s" % ('Updated', docked and " docked" or "!docked", updated and " updated" or "!updated")
+    def save_checkpoint(self):
+        if self.position:
+            save_checkpoint(self.checkpointfile, self.position)
 
-            # Check whether new log file started, e.g. client (re)started.
-            if self.observed:
-                newlogfile = self.logfile	# updated by on_created watchdog callback
-            else:
-                # Poll
-                try:
-                    logfiles = sorted([x for x in listdir(self.currentdir) if x.startswith('netLog.')])
-                    newlogfile = logfiles and join(self.currentdir, logfiles[-1]) or None
-                except:
-                    if __debug__: print_exc()
-                    newlogfile = None
-
-            if logfile != newlogfile:
-                logfile = newlogfile
-                if loghandle:
-                    loghandle.close()
-                if logfile:
-                    loghandle = open(logfile, 'r')
-                if __debug__:
-                    print 'New logfile "%s"' % logfile
-
-            if logfile:
-                system = visited = coordinates = None
-                loghandle.seek(0, SEEK_CUR)	# reset EOF flag
-
-                for line in loghandle:
-                    match = regexp.match(line)
-                    if match:
-                        (visited, system, x, y, z, context) = match.groups()
-                        if system == 'ProvingGround':
-                            system = 'CQC'
-                        coordinates = (float(x), float(y), float(z))
-                    else:
-                        match = dockre.match(line)
-                        if match:
-                            if match.group(2) == 'Undocked':
-                                docked = updated = False
-                            elif match.group(2) == 'Docked':
-                                docked = True
-                                # do nothing now in case the API server is lagging, but update on next poll
-                            if __debug__:
-                                print "%s :\t%s %s" % (match.group(2), docked and " docked" or "!docked", updated and " updated" or "!updated")
-
-                if system and not docked and config.getint('output'):
-                    # Convert local time string to UTC date and time
-                    visited_struct = strptime(visited, '%H:%M:%S')
-                    now = localtime()
-                    if now.tm_hour == 0 and visited_struct.tm_hour == 23:
-                        # Crossed midnight between timestamp and poll
-                        now = localtime(time()-12*60*60)	# yesterday
-                    time_struct = datetime(now.tm_year, now.tm_mon, now.tm_mday, visited_struct.tm_hour, visited_struct.tm_min, visited_struct.tm_sec).timetuple()	# still local time
-                    self.last_event = (mktime(time_struct), system, coordinates)
-                    self.root.event_generate('<<MonitorJump>>', when="tail")
-
-            sleep(self._POLL)
+    def latest(self, logdir):
+        # Latest logfile in logdir. Assumes logs sort alphabetically.
+        try:
+            logfiles = sorted([x for x in listdir(logdir) if x.startswith('netLog.')])
+            return logfiles and join(logdir, logfiles[-1]) or None
+        except:
+            return None
+
+    def resume(self, logdir, checkpoint):
+        # Returns [(logfile, offset)] to be read in order. Picks up where the checkpoint left off, including
+        # any logs written since, or else starts at the end of the latest log file.
+        logfile = self.latest(logdir)
+        if not logfile:
+            return []
+        if checkpoint:
+            (oldlogfile, inode, offset) = checkpoint
+            try:
+                info = stat(oldlogfile)
+                if (normpath(dirname(oldlogfile)) == normpath(logdir) and
+                    basename(oldlogfile) <= basename(logfile) and
+                    (not inode or info.st_ino == inode) and	# st_ino is always 0 on Windows
+                    offset <= info.st_size):
+                    later = sorted([x for x in listdir(logdir) if x.startswith('netLog.') and basename(oldlogfile) < x <= basename(logfile)])
+                    return [(oldlogfile, offset)] + [(join(logdir, x), 0) for x in later]
+            except:
+                if __debug__: print_exc()
+        return [(logfile, stat(logfile).st_size)]
+
+    def events(self, since=None, logdir=None, follow=True, laststate=None):
+        # Generates Jump, Dock, Undock and Position events from the netLogs in logdir (default the one being monitored).
+        # Starts from checkpoint since (e.g. from a previous event), or else from the end of the latest log.
+        # If follow, waits for new events as the client writes them until monitoring is stopped or
+        # restarted, otherwise stops once it has caught up. laststate is netlog.last_state() where we start, if known.
+        logdir = logdir or self.currentdir
+        generation = self.generation
+        follower = LogFollower(logdir, self.resume(logdir, since), self.pollstats, laststate)
+        changes = self.changes
+
+        try:
+            while True:
+                for event in follower.read():
+                    yield event
+
+                if not follow:
+                    return
+
+                if self.observed and platform == 'linux2':
+                    # inotify tells us when the log is written, so sleep until then
+                    with self.changed:
+                        if self.changes == changes and self.generation == generation:
+                            self.changed.wait()
+                        changes = self.changes
+                elif self.observed:
+                    sleep(self._POLL)
+                else:
+                    sleep(follower.interval)
+                    self.pollstats['polls'] += 1
+                    self.pollstats['polls saved'] += follower.interval // follower.pollmin - 1
+
+                # Check whether we're still supposed to be running
+                if self.generation != generation:
+                    return
+
+                # Check whether new log file started, e.g. client (re)started.
+                follower.check(self.observed and self.logfile)	# updated by on_created watchdog callback
+        finally:
+            follower.close()
+
+    def worker(self, since, laststate):
+        # Tk isn't thread-safe in general.
+        # event_generate() is the only safe way to poke the main thread from this thread:
+        # https://mail.python.org/pipermail/tkinter-discuss/2013-November/003522.html
+        for event in self.events(since, laststate=laststate):
 
             # Check whether we're still supposed to be running
             if threading.current_thread() != self.thread:
                 return	# Terminate
 
+            if isinstance(event, Jump):
+                self.system = event.system
+                self.coordinates = event.coordinates
+                if not self.docked and config.getint('output'):
+                    self.post_jump(event[:3])
+            elif isinstance(event, Dock):
+                self.docked = True
+                self.dockedtime = event.timestamp
+                # do nothing now in case the API server is lagging, but update shortly
+                if self.docktimer:
+                    self.docktimer.cancel()
+                self.docktimer = threading.Timer(self.dockdelay and self.dockdelay(event.timestamp) or self._POLL, self.post_dock, args = (self.generation,))
+                self.docktimer.daemon = True
+                self.docktimer.start()
+            elif isinstance(event, Undock):
+                self.docked = False
+                if self.docktimer:
+                    self.docktimer.cancel()
+                    self.docktimer = None
+            elif isinstance(event, Position):
+                if self.callbacks['Position']:
+                    self.post_position(event)
+                self.position = event.checkpoint
+                continue	# not worth a checkpoint write - saved with the next event or on exit
+            if __debug__ and not isinstance(event, Jump):
+                print "%s :\t%s" % (type(event).__name__, self.docked and " docked" or "!docked")
+
+            self.position = event.checkpoint
+            self.save_checkpoint()
+
+    def post_dock(self, generation):
+        # Called from the dock timer thread
+        if self.docked and generation == self.generation and not config.getint('output') & config.OUT_MKT_MANUAL:
+            self.root.event_generate('<<MonitorDock>>', when="tail")
+            if __debug__:
+                print 'Updated'
+
+    def post_jump(self, entry):
+        # Called from the worker thread. Blocks rather than drop the jump if the main thread has fallen behind,
+        # unless monitoring is stopped meanwhile. Only one <<MonitorJump>> event is outstanding at a time - the main
+        # thread handles everything queued.
+        generation = self.generation
+        jumps = self.jumps
+        while True:
+            try:
+                jumps.put(entry, timeout=self._POLL)
+                break
+            except Queue.Full:
+                if generation != self.generation:
+                    return
+        if generation != self.generation:
+            return	# stop() discarded the queue
+        with self.jumps_lock:
+            if self.jumps_pending:
+                return
+            self.jumps_pending = True
+        self.root.event_generate('<<MonitorJump>>', when="tail")
+
     def jump(self, event):
-        # Called from Tkinter's main loop
-        if self.callbacks['Jump'] and self.last_event:
-            self.callbacks['Jump'](event, *self.last_event)
+        # Called from Tkinter's main loop. Handles all jumps queued since the last event, in order.
+        with self.jumps_lock:
+            self.jumps_pending = False	# any jump queued from now on will generate a new event
+        while True:
+            try:
+                entry = self.jumps.get_nowait()
+            except Queue.Empty:
+                return
+            if self.callbacks['Jump']:
+                self.callbacks['Jump'](event, *entry)
 
     def dock(self, event):
         # Called from Tkinter's main loop
         if self.callbacks['Dock']:
             self.callbacks['Dock'](event)
 
+    def post_position(self, entry):
+        # Called from the worker thread. Positions can arrive many times a second, so only the latest is kept
+        # and at most one <<MonitorPosition>> event is generated every position_interval ms.
+        with self.jumps_lock:
+            self.latestposition = entry
+            if self.position_pending:
+                return
+            self.position_pending = True
+        delay = self.positiontime + (config.getint('position_interval') or self._POSITION_INTERVAL) / 1000.0 - time()
+        if delay > 0:
+            with self.jumps_lock:
+                self.positiontimer = threading.Timer(delay, self.root.event_generate, args = ('<<MonitorPosition>>',), kwargs = { 'when': 'tail' })
+                self.positiontimer.daemon = True
+                self.positiontimer.start()
+        else:
+            self.root.event_generate('<<MonitorPosition>>', when="tail")
+
+    def moved(self, event):
+        # Called from Tkinter's main loop
+        with self.jumps_lock:
+            self.position_pending = False
+            (entry, self.latestposition) = (self.latestposition, None)
+        self.positiontime = time()
+        if entry and self.callbacks['Position']:
+            self.callbacks['Position'](event, *entry[:4])
+
     def is_valid_logdir(self, path):
         return self._is_valid_logdir(path)
 
@@ -318,6 +504,11 @@ class EDLogs(FileSystemEventHandler):
             # Apple's SMB implementation is too flaky so assume target machine is OSX
             return path and isdir(path) and isfile(join(path, pardir, 'AppNetCfg.xml'))
 
+        def _must_poll(self, path):
+            # We can't easily tell whether a path points to a network drive, so assume
+            # any non-standard logdir might be on a network drive.
+            return bool(config.get('logdir'))
+
         def _logging_enabled(self, path):
             if not self._is_valid_logdir(path):
                 return False
@@ -410,6 +601,9 @@ class EDLogs(FileSystemEventHandler):
             # Assume target machine is Windows
             return path and isdir(path) and isfile(join(path, pardir, 'AppConfig.xml'))
 
+        def _must_poll(self, path):
+            return False
+
         def _logging_enabled(self, path):
             if not self._is_valid_logdir(path):
                 return False
@@ -436,6 +630,23 @@ class EDLogs(FileSystemEventHandler):
         def _is_valid_logdir(self, path):
             return path and isdir(path) and isfile(join(path, pardir, 'AppConfig.xml'))
 
+        def _must_poll(self, path):
+            # inotify doesn't work over CIFS or NFS, so poll if the logdir is on a network filesystem
+            if not Observer:
+                return True
+            path = realpath(path)
+            (mountpoint, fstype) = ('', '')
+            try:
+                with open('/proc/mounts', 'rt') as h:
+                    for line in h:
+                        fields = line.split()
+                        mount = fields[1].replace('\\040', ' ')
+                        if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(mountpoint):
+                            (mountpoint, fstype) = (mount, fields[2])
+            except:
+                return True
+            return fstype in ['cifs', 'smbfs', 'smb3', 'nfs', 'nfs4', '9p', 'fuse.sshfs']
+
         def _logging_enabled(self, path):
             if not self._is_valid_logdir(path):
                 return False
@@ -452,5 +663,243 @@ class EDLogs(FileSystemEventHandler):
                                                    join(path, pardir, 'AppConfig.xml'))
 
 
+class LogFollower:
+
+    # Reads Jump, Dock, Undock and Position events from the netLogs in one logdir without blocking, moving on to new
+    # logs as the client starts them. Waiting for the client to write more is up to the caller.
+
+    def __init__(self, logdir, backlog, pollstats=None, laststate=None):
+        self.logdir = logdir
+        self.backlog = backlog	# [(logfile, offset)] still to be read
+        self.pollstats = pollstats or { 'polls': 0, 'polls saved': 0, 'listdirs': 0, 'listdirs saved': 0 }
+        self.logfile = None
+        self.tail = None
+        self.clock = None
+
+        # System of the last System line - later lines in the same system are Positions. Seeded from the log before
+        # where we start, so that carrying on in the same system after a restart isn't reported as a jump.
+        # laststate is netlog.last_state() there, if the caller already knows it.
+        jump = (laststate or backlog and netlog.last_state(*backlog[0]) or (None, None))[0]
+        self.system = jump and jump.system or None
+
+        # When polling, back off from logpoll_min to logpoll_max seconds while the client is idle
+        self.pollmin = config.getint('logpoll_min') or EDLogs._POLL
+        self.pollmax = max(self.pollmin, config.getint('logpoll_max') or EDLogs._POLL_MAX)
+        self.interval = self.pollmin
+        self.lastactive = time()
+        self.dirmtime = None	# Only re-list the logdir when this changes
+
+    def close(self):
+        if self.tail:
+            self.tail.close()
+            self.tail = None
+
+    def read(self):
+        # Returns the events written since the last call, oldest first
+        events = []
+        active = False
+        while True:
+            if self.backlog and not self.tail:
+                (self.logfile, offset) = self.backlog.pop(0)
+                try:
+                    self.tail = netlog.LogTail(self.logfile, offset)
+                    self.clock = LogClock(self.logfile)
+                    if __debug__:
+                        print 'Read logfile "%s" from %d' % (self.logfile, offset)
+                except EnvironmentError:
+                    if __debug__: print_exc()
+                    continue
+
+            if self.tail:
+                offset = self.tail.offset
+                while True:
+                    (logfile, inode, clock) = (self.logfile, self.tail.inode, self.clock)
+                    for (record, end) in self.tail.read():
+                        if isinstance(record, netlog.Jump):
+                            if record.system != self.system:
+                                self.system = record.system
+                                events.append(Jump(clock(record.time), record.system, record.coordinates, (logfile, inode, end)))
+                            elif record.body is not None:
+                                events.append(Position(clock(record.time), record.system, record.body, record.relpos, (logfile, inode, end)))
+                        elif record.status == 'Docked':
+                            events.append(Dock(clock(record.time), (logfile, inode, end)))
+                        elif record.status == 'Undocked':
+                            events.append(Undock(clock(record.time), (logfile, inode, end)))
+                    if not self.tail.reopened:
+                        break
+                    # Log truncated or replaced - start over with the new contents
+                    self.clock = LogClock(self.logfile)
+                    offset = -1
+                    if __debug__:
+                        print 'Reopened logfile "%s"' % self.logfile
+                active = active or self.tail.offset != offset
+
+            if self.backlog:
+                # Catching up, or the client has moved on to a new log - move on now that we've finished this one
+                self.close()
+            else:
+                break
+
+        if active:
+            self.lastactive = time()
+            self.interval = self.pollmin
+        elif time() - self.lastactive > EDLogs._IDLE:
+            self.interval = min(self.interval * 2, self.pollmax)
+        return events
+
+    def check(self, newlogfile=None):
+        # Arrange for read() to move on to newlogfile once it has finished the current log. If newlogfile isn't
+        # known, e.g. when polling, look for it in the logdir. Listing a big logdir on a network drive is slow,
+        # so only do so if its contents have changed.
+        if not newlogfile:
+            try:
+                mtime = stat(self.logdir).st_mtime
+                if mtime != self.dirmtime:
+                    newlogfile = monitor.latest(self.logdir)
+                    self.dirmtime = mtime
+                    self.pollstats['listdirs'] += 1
+                else:
+                    self.pollstats['listdirs saved'] += 1
+            except:
+                if __debug__: print_exc()
+                self.dirmtime = None
+
+        if newlogfile and newlogfile != self.logfile and newlogfile not in [x[0] for x in self.backlog]:
+            self.backlog.append((newlogfile, 0))
+            if __debug__:
+                print 'New logfile "%s"' % newlogfile
+
+
+class MultiLogs(FileSystemEventHandler):
+
+    # Monitors several E:D clients' logdirs - e.g. one per commander where several accounts are played on one
+    # machine - sharing one watchdog observer and one reader thread. Each logdir has its own checkpoint,
+    # and its events are passed to callback(commander, event) on the reader thread.
+
+    def __init__(self, callback=None):
+        FileSystemEventHandler.__init__(self)
+        self.callback = callback
+        self.followers = {}	# commander -> LogFollower
+        self.watches = {}	# commander -> watchdog ObservedWatch, or None if polling
+        self.due = {}		# commander -> time of next read, or None if we rely on inotify
+        self.dirty = set()	# logdirs written since they were last read
+        self.created = {}	# logdir -> newest log started since it was last read
+        self.retired = []	# removed followers, to be closed by the reader thread
+        self.changed = threading.Condition()
+        self.thread = None
+        self.pollstats = { 'polls': 0, 'polls saved': 0, 'listdirs': 0, 'listdirs saved': 0 }
+
+    def checkpointfile(self, commander):
+        return join(config.app_dir, 'netlog-%s.json' % re.sub(r'[^\w-]', '_', commander))
+
+    def add(self, commander, logdir):
+        # Start following logdir for commander, carrying on from where we last left off
+        if not monitor.is_valid_logdir(logdir):
+            return False
+        self.remove(commander)
+        logdir = normpath(logdir)
+        follower = LogFollower(logdir, monitor.resume(logdir, load_checkpoint(self.checkpointfile(commander))), self.pollstats)
+        polling = monitor._must_poll(logdir)
+        with self.changed:
+            self.followers[commander] = follower
+            self.watches[commander] = not polling and shared_observer().schedule(self, logdir) or None
+            self.due[commander] = (polling or platform != 'linux2') and time() or None	# read the backlog straight away
+            self.dirty.add(logdir)
+            self.changed.notify_all()
+        if __debug__:
+            print '%s "%s" for %s' % (polling and 'Polling' or 'Monitoring', logdir, commander)
+        return True
+
+    def remove(self, commander):
+        with self.changed:
+            follower = self.followers.pop(commander, None)
+            watch = self.watches.pop(commander, None)
+            self.due.pop(commander, None)
+            if follower:
+                self.retired.append(follower)
+        if watch:
+            shared_observer().unschedule(watch)
+        if not self.running():
+            self.close_retired()
+
+    def start(self):
+        if not self.running():
+            self.thread = threading.Thread(target = self.worker, name = 'netLog multi worker')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        for commander in self.followers.keys():
+            self.remove(commander)
+        with self.changed:
+            self.thread = None	# Orphan the worker thread - will terminate at next wakeup
+            self.changed.notify_all()
+
+    def running(self):
+        return self.thread and self.thread.is_alive()
+
+    def close_retired(self):
+        with self.changed:
+            (retired, self.retired) = (self.retired, [])
+        for follower in retired:
+            follower.close()
+
+    def on_created(self, event):
+        # watchdog callback, e.g. client (re)started.
+        if not event.is_directory and basename(event.src_path).startswith('netLog.'):
+            with self.changed:
+                self.created[dirname(event.src_path)] = event.src_path
+                self.dirty.add(dirname(event.src_path))
+                self.changed.notify_all()
+
+    def on_modified(self, event):
+        # watchdog callback, e.g. client wrote to the log.
+        if not event.is_directory and basename(event.src_path).startswith('netLog.'):
+            with self.changed:
+                self.dirty.add(dirname(event.src_path))
+                self.changed.notify_all()
+
+    def worker(self):
+        while True:
+            with self.changed:
+                # Sleep until a log is written or a polled logdir is due
+                while not self.dirty and threading.current_thread() == self.thread:
+                    due = [x for x in self.due.itervalues() if x is not None]
+                    if not due:
+                        self.changed.wait()
+                    elif min(due) > time():
+                        self.changed.wait(min(due) - time())
+                    else:
+                        break
+                if threading.current_thread() != self.thread:
+                    self.close_retired()
+                    return	# Terminate
+
+                now = time()
+                todo = [(commander, follower) for (commander, follower) in self.followers.iteritems()
+                        if follower.logdir in self.dirty or self.due[commander] is not None and self.due[commander] <= now]
+                (dirty, self.dirty) = (self.dirty, set())
+                (created, self.created) = (self.created, {})
+
+            self.close_retired()
+            for (commander, follower) in todo:
+                follower.check(created.get(follower.logdir))
+                event = None
+                for event in follower.read():
+                    if self.followers.get(commander) is not follower:
+                        break	# removed
+                    if self.callback:
+                        self.callback(commander, event)
+                if event:
+                    save_checkpoint(self.checkpointfile(commander), event.checkpoint)
+                with self.changed:
+                    if self.due.get(commander) is not None:
+                        polling = not self.watches[commander]
+                        self.due[commander] = time() + (polling and follower.interval or EDLogs._POLL)
+                        if polling:
+                            self.pollstats['polls'] += 1
+                            self.pollstats['polls saved'] += follower.interval // follower.pollmin - 1
+
+
 # singleton
 monitor = EDLogs()
@@ -0,0 +1,245 @@
+#
+# Parsing of the E:D client's netLog
+#
+
+from calendar import timegm
+from collections import namedtuple
+import mmap
+from os import fstat, stat
+from os.path import basename
+import re
+from time import gmtime, localtime, mktime
+
+
+# Parsed records.
+# time is the client's local time string "HH:MM:SS", coordinates is (x, y, z) in ly.
+# With VerboseLogging body is the id of the nearest body and relpos is our (x, y, z) relative to it in km,
+# otherwise both are None.
+Jump = namedtuple('Jump', ['time', 'system', 'coordinates', 'context', 'body', 'relpos'])
+Dock = namedtuple('Dock', ['time', 'status', 'landed'])	# status is 'Docked' or 'Undocked'
+
+
+# e.g.:
+#   "{18:00:41} System:"Shinrarta Dezhra" StarPos:(55.719,17.594,27.156)ly  NormalFlight\r\n"
+# or with verboseLogging:
+#   "{17:20:18} System:"Shinrarta Dezhra" StarPos:(55.719,17.594,27.156)ly Body:69 RelPos:(0.334918,1.20754,1.23625)km NormalFlight\r\n"
+# or:
+#   "... Supercruise\r\n"
+# Note that system name may contain parantheses, e.g. "Pipe (stem) Sector PI-T c3-5".
+_systemre = re.compile(r'\{([^}]+)\} System:"(.+)" StarPos:\(([^,]+),([^,]+),([^)]+)\)ly(?: Body:(\d+) RelPos:\(([^,]+),([^,]+),([^)]+)\)km)?.* (\S+)')	# (localtime, system, x, y, z, body, rx, ry, rz, context)
+
+# e.g.:
+#   "{14:42:11} GetSafeUniversalAddress Station Count 1 moved 0 Docked Not Landed\r\n"
+# or:
+#   "... Undocked Landed\r\n"
+# Don't use the simpler "Commander Put ..." message since its more likely to be delayed.
+_dockre = re.compile(r'\{([^}]+)\} GetSafeUniversalAddress Station Count \d+ moved \d+ (\S+) ([^\r\n]+)')	# (localtime, docked_status, landed_status)
+
+
+def parse(line):
+    # Returns a Jump or Dock record, or None if the line isn't interesting.
+    # With VerboseLogging almost every line is uninteresting, so reject those on the word following the
+    # timestamp before running any regexp.
+    end = line.find('} ', 0, 40)
+    if end < 0:
+        return None
+    tag = line[end+2:end+8]
+    if tag == 'System':
+        match = _systemre.match(line)
+        if match:
+            (visited, system, x, y, z, body, rx, ry, rz, context) = match.groups()
+            if system == 'ProvingGround':
+                system = 'CQC'
+            if body:
+                return Jump(visited, system, (float(x), float(y), float(z)), context, int(body), (float(rx), float(ry), float(rz)))
+            else:
+                return Jump(visited, system, (float(x), float(y), float(z)), context, None, None)
+    elif tag == 'GetSaf':
+        match = _dockre.match(line)
+        if match:
+            return Dock(*match.groups())
+    return None
+
+
+class LogTail:
+
+    # Follows a netLog as the client writes it, returning parsed records with the offset just past each.
+    #
+    # Reads in big chunks and picks out interesting lines with a regexp, so the uninteresting majority of a
+    # VerboseLogging log never goes through Python line-by-line. A partially written final line is held back
+    # until its newline arrives. If the file is truncated or replaced under the same name, whatever remains
+    # of the old file is read and then the new one is followed from the start.
+
+    CHUNK = 64 * 1024
+
+    _linesre = re.compile(r'\} (?:System|GetSaf)[^\n]*\n')	# leading literal lets the regexp engine skip ahead fast
+
+    def __init__(self, filename, offset=0):
+        self.filename = filename
+        self.handle = open(filename, 'rb')
+        self.inode = fstat(self.handle.fileno()).st_ino
+        self.handle.seek(offset)
+        self.offset = offset	# end of last complete line read
+        self.partial = ''	# incomplete line following offset
+        self.reopened = False	# set when read() switches to a replacement file
+
+    def close(self):
+        self.handle.close()
+
+    def read(self):
+        # Returns [(record, offset)] for the complete lines written since the last call.
+        self.reopened = False
+        records = []
+        while True:
+            chunk = self.handle.read(self.CHUNK)
+            if not chunk:
+                break
+            data = self.partial + chunk
+            end = data.rfind('\n') + 1
+            self.partial = data[end:]
+            for match in self._linesre.finditer(data, 0, end):
+                record = parse(data[data.rfind('\n', 0, match.start()) + 1 : match.end()])
+                if record:
+                    records.append((record, self.offset + match.end()))
+            self.offset += end
+
+        try:
+            info = stat(self.filename)
+        except EnvironmentError:
+            return records	# gone - hope it comes back
+        if info.st_ino != self.inode or info.st_size < self.offset + len(self.partial):
+            # Replaced or truncated. st_ino is always 0 on Windows so we only spot truncation there.
+            self.handle.close()
+            self.handle = open(self.filename, 'rb')
+            self.inode = fstat(self.handle.fileno()).st_ino
+            self.offset = 0
+            self.partial = ''
+            self.reopened = True
+        return records
+
+
+def last_state(filename, end=None):
+    # Returns the most recent (Jump, Dock) records before offset end in a netLog, either of which may be None.
+    # Scans backwards from end so only reads as far back as our arrival in the current system, however big the log
+    # has grown.
+    try:
+        with open(filename, 'rb') as h:
+            logmap = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):	# can't mmap an empty file
+        return (None, None)
+    try:
+        if end is None or end > len(logmap):
+            end = len(logmap)
+        jump = dock = None
+        start = 0
+        found = _rfind(logmap, '} System:"', 0, end, Jump)
+        if found:
+            jump = parse(logmap[found[0]:found[1]])
+            start = _arrival(logmap, found)
+        # Look for the dock status on its own terms, since later System lines in the same system are normal while
+        # docked. A jump always comes after an Undock, so a status from before we arrived in this system can't be
+        # current.
+        found = _rfind(logmap, '} GetSafeUniversalAddress ', start, end, Dock)
+        if found:
+            dock = parse(logmap[found[0]:found[1]])
+        return (jump, dock)
+    finally:
+        logmap.close()
+
+def _arrival(logmap, found):
+    # Returns the start of the line after the last System line for a different system before the System line at
+    # found, or 0 if there isn't one
+    line = logmap[found[0]:found[1]]
+    tagstart = line.find('} System:"')
+    tag = line[tagstart : line.find('" StarPos:', tagstart) + 1]	# e.g. '} System:"Sol"'
+    end = found[0]
+    while True:
+        pos = logmap.rfind('} System:"', 0, end)
+        if pos < 0:
+            return 0
+        elif logmap[pos : pos+len(tag)] != tag:
+            return logmap.find('\n', pos, end) + 1 or end
+        end = pos
+
+def _rfind(logmap, tag, start, end, kind):
+    # Returns (start, end) of the last complete line in [start, end) containing tag that parses as kind, or None
+    while True:
+        pos = logmap.rfind(tag, start, end)
+        if pos < 0:
+            return None
+        linestart = logmap.rfind('\n', start, pos) + 1 or start
+        lineend = logmap.find('\n', pos, end)
+        if lineend >= 0 and isinstance(parse(logmap[linestart:lineend]), kind):
+            return (linestart, lineend)
+        end = linestart
+
+
+class LogClock:
+
+    # Converts the client's local "HH:MM:SS" netLog timestamps into UTC epoch seconds.
+    #
+    # The date and UTC offset come from the netLog's header, e.g.
+    #   "16-10-17-12:00 GMT Daylight Time  (11:00 GMT)"
+    # and day rollover is tracked as timestamps go by. If the client's timezone matches ours we follow
+    # our timezone's DST rules (looked up at most once an hour), otherwise the offset is fixed.
+    # Either way the clock going back by more than a few minutes, e.g. at the end of DST, adjusts the offset.
+
+    _headerre = re.compile(r'(\d\d)-(\d\d)-(\d\d)-(\d\d):(\d\d) .*\((\d\d):(\d\d) GMT\)')
+    _filenamere = re.compile(r'netLog\.(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)\.')
+
+    DAY = 24*60*60
+
+    def __init__(self, filename=None):
+        self.bucket = None	# Hour for which self.offset was looked up from our timezone
+        header = None
+        if filename:
+            try:
+                with open(filename, 'r') as h:
+                    header = self._headerre.search(h.read(1024))
+            except EnvironmentError:
+                pass
+
+        if header:
+            (year, month, day, hour, minute, gmthour, gmtminute) = [int(x) for x in header.groups()]
+            diff = (hour*60 + minute) - (gmthour*60 + gmtminute)
+            if diff > 14*60:
+                diff -= 24*60
+            elif diff < -12*60:
+                diff += 24*60
+            self.offset = diff * 60
+        else:
+            match = filename and self._filenamere.match(basename(filename))
+            if match:
+                (year, month, day, hour, minute) = [int(x) for x in match.groups()]
+            else:
+                (year, month, day, hour, minute) = localtime()[:5]
+            self.offset = None
+
+        self.day = timegm((year % 100 + 2000, month, day, 0, 0, 0))	# local midnight, as if it were UTC
+        self.last = hour*3600 + minute*60	# local seconds since midnight of the last timestamp
+        hostoffset = self._hostoffset(self.day + self.last)
+        self.hosttz = self.offset is None or self.offset == hostoffset
+        if self.hosttz:
+            self.offset = hostoffset
+            self.bucket = (self.day + self.last) // 3600
+
+    def __call__(self, visited):
+        secs = int(visited[0:2])*3600 + int(visited[3:5])*60 + int(visited[6:8])
+        if secs < self.last:
+            if self.last - secs > 12*60*60:
+                self.day += self.DAY	# crossed midnight
+            elif self.last - secs >= 15*60:
+                # Clock put back, e.g. at the end of DST. Our timezone's rules are ambiguous for the repeated hour.
+                self.offset -= (self.last - secs + 450) // 900 * 900
+                self.bucket = (self.day + secs) // 3600
+        self.last = secs
+        local = self.day + secs
+        if self.hosttz and local // 3600 != self.bucket:
+            self.offset = self._hostoffset(local)
+            self.bucket = local // 3600
+        return local - self.offset
+
+    def _hostoffset(self, local):
+        # Our timezone's offset from UTC at the given local time
+        localtuple = gmtime(local)[:8] + (-1,)
+        return local - int(mktime(localtuple))
@@ -5,6 +5,7 @@ import time
 
 import companion
 from config import config
+import model
 
 
 # Map API module names to in-game names
@@ -234,6 +235,29 @@ internal_map = {
 moduledata = cPickle.load(open(join(config.respath, 'modules.p'),  'rb'))
 
 
+# id(ship_map) -> (ship_map, { (id, name, sku, on, priority, entitled) -> Module, or None if not interesting }).
+# The answer only depends on these, and there are only so many modules in the game. Each ship_map is held on to
+# so that its id can't be reused by another map. Emptied if it grows unexpectedly big.
+lookups = {}
+LOOKUPS_MAPS = 8
+LOOKUPS_MODULES = 10000
+
+def lookup_record(module, ship_map, entitled=False):
+    # As lookup(), but returns a read-only model.Module shared between callers
+    cache = lookups.get(id(ship_map))
+    if not cache:
+        if len(lookups) >= LOOKUPS_MAPS:
+            lookups.clear()
+        cache = lookups[id(ship_map)] = (ship_map, {})
+    modules = cache[1]
+    key = (module.get('id'), module.get('name'), module.get('sku'), module.get('on'), module.get('priority'), entitled)
+    if key not in modules:
+        if len(modules) >= LOOKUPS_MODULES:
+            modules.clear()
+        new = lookup(module, ship_map, entitled)
+        modules[key] = new and model.Module(new)	# unrecognized modules raise and aren't cached
+    return modules[key]
+
 # Given a module description from the Companion API returns a description of the module in the form of a
 # dict { category, name, [mount], [guidance], [ship], rating, class } using the same terms found in the
 # English langauge game. For fitted modules, dict also includes { enabled, priority }.
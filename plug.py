@@ -6,6 +6,8 @@ import imp
 import sys
 
 from config import config
+import delta
+import model
 
 """
 Dictionary of loaded plugin modules.
@@ -106,16 +108,52 @@ def notify_system_changed(timestamp, system, coordinates):
                 print plugerr
 
 
-def notify_newdata(data):
+def wants_position():
     """
-    Send the latest EDMC data from the FD servers to each plugin
+    Whether any plugin wants to be told about movement within a system.
+    :return:
+    """
+    return bool([x for x in PLUGINS if _get_plugin_func(x, "position_changed")])
+
+
+def notify_position_changed(timestamp, system, body, relpos):
+    """
+    Send our position within the current system to each plugin. Throttled to at most once every
+    position_interval ms (default 1000).
+    :param timestamp:
+    :param system:
+    :param body:
+    :param relpos:
+    :return:
+    """
+    for plugname in PLUGINS:
+        position_changed = _get_plugin_func(plugname, "position_changed")
+        if position_changed:
+            try:
+                position_changed(timestamp, system, body, relpos)
+            except Exception as plugerr:
+                print plugerr
+
+
+def notify_newdata(data, changed=None):
+    """
+    Send the latest EDMC data from the FD servers to each plugin. Plugins that list the sections of the data
+    that they use in cmdr_data_sections are skipped if none of those sections have changed. Plugins get the
+    data as plain dicts, unless they set cmdr_data_records to get the compact records from model.py.
     :param data:
+    :param changed: set of delta sections that have changed since the last data, or None if not known
     :return:
     """
+    plain = None
     for plugname in PLUGINS:
         cmdr_data = _get_plugin_func(plugname, "cmdr_data")
-        if cmdr_data:
+        if cmdr_data and delta.wanted(changed, getattr(PLUGINS[plugname], "cmdr_data_sections", None)):
             try:
-                cmdr_data(data)
+                if getattr(PLUGINS[plugname], "cmdr_data_records", False):
+                    cmdr_data(data)
+                else:
+                    if plain is None:
+                        plain = model.plain(data)	# only made if needed, and shared like data used to be
+                    cmdr_data(plain)
             except Exception as plugerr:
                 print plugerr
@@ -0,0 +1,244 @@
+#
+# Schedules every Companion API profile query, so that however many things want data we stay polite.
+#
+# Fetches are rate limited by a token bucket that's shared, through the config, with other instances of the
+# app and with the command-line app. Requests wait in priority lanes and when a token is free the highest
+# priority request that's due is sent, together with any other requests that are due - they all share the
+# one fetch. Lower priority lanes leave tokens in the bucket so that they can't starve the higher ones.
+# Requests with the same key collapse into one, e.g. pressing Update while the post-dock query is waiting.
+#
+# Pool schedules the queries of several commanders, each with their own token bucket, on one thread.
+#
+
+from functools import partial
+import heapq
+from itertools import count
+from math import ceil
+import threading
+from time import time, sleep
+
+if __debug__:
+    from traceback import print_exc
+
+from config import config
+import companion
+
+
+DOCK, SHIPYARD, MANUAL, STATUS = range(4)	# lanes, highest priority first
+
+# lane -> tokens that must be left in the bucket for higher priority lanes
+RESERVE = {
+    DOCK:     0,	# automatic query after docking, and its retries
+    SHIPYARD: 0,	# retries for missing shipyard data
+    MANUAL:   2,	# Update button and hotkey - i.e. needs a full bucket
+    STATUS:   2,	# Status and Save Raw Data - usually answered from the cached profile anyway
+}
+
+
+class Request:
+
+    def __init__(self, lane, callback, due, maxage, key):
+        self.lane = lane
+        self.callback = callback
+        self.due = due
+        self.maxage = maxage
+        self.key = key
+
+
+class Scheduler:
+
+    # The bucket is held as the time at which it will be full, which is easy to persist. A fetch moves this
+    # on by REFILL, so with BURST tokens there can be BURST fetches back to back but over any longer period
+    # no more than one per REFILL.
+
+    BURST = 3
+    REFILL = companion.holdoff	# seconds per token
+
+    def __init__(self, session, after=None, commander=None):
+        # after(ms, fn) calls fn on the thread that should make queries, e.g. Tk's after(). Not needed if only
+        # the blocking query() is used. commander is given for sessions in a companion.SessionPool, which each
+        # have their own bucket.
+        self.session = session
+        self.after = after
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None	# when the next run() is scheduled for
+        if commander is None:
+            self.bucketkey = 'querybucket'
+            self.full = config.getint('querybucket') or config.getint('querytime') + self.REFILL
+            self.lastfetch = config.getint('querytime')
+        else:
+            self.bucketkey = 'querybucket_' + companion.account_key(commander)
+            self.full = config.getint(self.bucketkey)
+            self.lastfetch = 0
+
+    def next_free(self, lane=MANUAL):
+        # Earliest time at which a fetch in lane could be sent
+        with self.lock:
+            return self.free(lane)
+
+    def free(self, lane):
+        return self.full - (self.BURST - 1 - RESERVE[lane]) * self.REFILL
+
+    def take(self):
+        # Spend a token
+        now = time()
+        self.full = max(self.full, now) + self.REFILL
+        self.lastfetch = now
+        config.set(self.bucketkey, int(self.full + 0.5))
+
+    def submit(self, lane, callback, delay=0, maxage=0, key=None):
+        # Call callback(query) on the querying thread no earlier than delay seconds from now, where query(sections)
+        # returns the profile or raises as Session.query(maxage, sections). Replaces any waiting request with the same key (default
+        # the callback), keeping the higher priority lane and its callback and the earlier due time.
+        request = Request(lane, callback, time() + delay, maxage, key is None and callback or key)
+        with self.lock:
+            for old in self.pending:
+                if old.key == request.key:
+                    self.pending.remove(old)
+                    if old.lane < request.lane:
+                        (request.lane, request.callback, request.maxage) = (old.lane, old.callback, old.maxage)
+                    request.due = min(request.due, old.due)
+                    break
+            self.pending.append(request)
+        self.run()
+
+    def waiting(self, key):
+        # Whether a request with this key is waiting
+        with self.lock:
+            return bool([x for x in self.pending if x.key == key])
+
+    def run(self):
+        # Send whatever's due and can be sent, and arrange to be called again when the next request can go
+        now = time()
+        with self.lock:
+            due = sorted([x for x in self.pending if x.due <= now], key=lambda x: x.lane)
+            batch = [x for x in due if self.session.cached(x.maxage)]	# don't need a token
+            fetch = [x for x in due if x not in batch]
+            if fetch and self.free(fetch[0].lane) <= now:
+                self.take()
+                batch.extend(fetch)
+            for request in batch:
+                self.pending.remove(request)
+
+            # When to look again
+            wakeup = [max(x.due, self.session.cached(x.maxage) and x.due or self.free(x.lane)) for x in self.pending]
+            if wakeup and self.after and (self.timer is None or min(wakeup) < self.timer):
+                self.timer = min(wakeup)
+                self.after(max(0, int(ceil((self.timer - now) * 1000))), self.tick)
+
+        # Requests that go together share one fetch, and any error from it
+        state = { 'start': now }
+        for request in batch:
+            try:
+                request.callback(partial(self.query_batch, state, request.maxage))
+            except:
+                if __debug__: print_exc()
+
+    def tick(self):
+        with self.lock:
+            self.timer = None
+        self.run()
+
+    def query_batch(self, state, maxage, sections=None):
+        if 'error' in state:
+            raise state['error']
+        try:
+            if maxage is None:
+                return self.session.query(None, sections)	# default age is longer than this batch
+            else:
+                return self.session.query(max(maxage, time() - state['start']), sections)
+        except Exception as e:
+            state['error'] = e
+            raise
+
+    def query(self, lane, delay=0, maxage=0, sections=None):
+        # Blocking query for the command-line app. Waits for a free token, and for delay seconds.
+        with self.lock:
+            wait = max(delay, not self.session.cached(maxage) and self.free(lane) - time() or 0)
+        if wait > 0:
+            sleep(wait)
+        with self.lock:
+            if not self.session.cached(maxage):
+                self.take()
+        return self.session.query(maxage, sections)
+
+
+class Pool:
+
+    # A Scheduler for each commander in a companion.SessionPool, all running on the same thread. Since each
+    # commander has their own bucket one commander's queries can't use up another's tokens, and requests for
+    # different commanders that fall due together are sent in turn.
+
+    def __init__(self, sessions, after):
+        self.sessions = sessions
+        self.after = after
+        self.lock = threading.Lock()
+        self.schedulers = {}	# commander -> Scheduler
+
+    def scheduler(self, commander):
+        with self.lock:
+            scheduler = self.schedulers.get(commander)
+            if not scheduler:
+                session = self.sessions.get(commander)
+                if not session:
+                    raise KeyError(commander)
+                scheduler = self.schedulers[commander] = Scheduler(session, self.after, commander)
+            return scheduler
+
+    def submit(self, commander, lane, callback, delay=0, maxage=0, key=None):
+        # As Scheduler.submit() for the commander's session
+        self.scheduler(commander).submit(lane, callback, delay, maxage, key)
+
+    def remove(self, commander):
+        # Forget the commander's waiting requests. Doesn't touch their session.
+        with self.lock:
+            scheduler = self.schedulers.pop(commander, None)
+        if scheduler:
+            with scheduler.lock:
+                scheduler.pending = []
+
+
+class Loop:
+
+    # Provides after() for running Schedulers without Tk, e.g. in a service. Functions that are due at the same
+    # time are called in the order in which they were scheduled.
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = []	# heap of (due, sequence, fn)
+        self.sequence = count()
+        self.stopped = False
+
+    def after(self, ms, fn):
+        with self.cond:
+            heapq.heappush(self.queue, (time() + ms / 1000.0, next(self.sequence), fn))
+            self.cond.notify()
+
+    def run(self, until=None):
+        # Call functions as they fall due until stop() is called, or until time until
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    now = time()
+                    if until is not None and now >= until:
+                        return
+                    if self.queue and self.queue[0][0] <= now:
+                        break
+                    wakeup = [x[0] for x in self.queue[:1]] + [x for x in [until] if x is not None]
+                    if wakeup:
+                        self.cond.wait(min(wakeup) - now)
+                    else:
+                        self.cond.wait()
+                if self.stopped:
+                    return
+                fn = heapq.heappop(self.queue)[2]
+            try:
+                fn()
+            except:
+                if __debug__: print_exc()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
@@ -12,6 +12,7 @@ import myNotebook as nb
 import companion
 from companion import ship_map
 import prefs
+import scheduler
 
 
 RANKS = [	# in output order
@@ -164,7 +165,7 @@ class StatsDialog():
 
     def __init__(self, app):
         self.parent = app.w
-        self.session = app.session
+        self.scheduler = app.scheduler
         self.status = app.status
         self.verify = app.verify
         self.showstats()
@@ -172,9 +173,12 @@ class StatsDialog():
     def showstats(self):
         self.status['text'] = _('Fetching data...')
         self.parent.update_idletasks()
+        self.scheduler.submit(scheduler.STATUS, self.gotstats, maxage=None)
 
+    # callback from scheduler
+    def gotstats(self, query):
         try:
-            data = self.session.query()
+            data = query()
         except companion.VerificationRequired:
             return prefs.AuthenticationDialog(self.parent, partial(self.verify, self.showstats))
         except companion.ServerError as e:
@@ -10,6 +10,10 @@ from sys import platform
 import time
 
 from config import applongname, appversion, config
+import delta
+
+# Sections of the profile used
+sections = [delta.SYSTEM, delta.STATION, delta.MARKET]
 
 demandbracketmap = { 0: '?',
                      1: 'L',
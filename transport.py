@@ -0,0 +1,214 @@
+#
+# All outbound HTTP goes through here, so that connections to each host are kept alive and reused, and
+# timeouts, retries and compression are the same everywhere. Also keeps per-host metrics and can record
+# to, or replay from, a cassette file so that the network layer can be exercised offline.
+#
+
+import base64
+from collections import defaultdict
+from cookielib import DefaultCookiePolicy
+from io import BytesIO
+import json
+from os import rename, unlink
+from os.path import exists
+import threading
+from time import time
+from urllib import urlencode
+from urlparse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from requests.packages.urllib3.util.retry import Retry
+
+
+TIMEOUT = 10	# default (connect, read) timeout [s]
+
+# Retry failed connections, and idempotent requests that get a gateway error, with backoff of 0s, 1s.
+# Don't retry reads, which might have reached the server, or POSTs. Sessions for rate limited servers, e.g. the
+# Companion API, don't retry at all - see Session.
+RETRY = Retry(total=2, connect=2, read=0, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False)
+
+POOL_HOSTS = 8	# hosts to keep connections open to
+POOL_SIZE = 4	# connections per host, i.e. concurrent requests to the same host
+
+REDACT = ['email', 'password', 'code']	# form fields that aren't recorded in cassettes
+
+
+class Cassette:
+
+    # Recorded HTTP interactions, matched on method, URL and body. Each response is recorded as it came off
+    # the wire, i.e. redirects are recorded separately. Repeated identical requests are answered in the order
+    # they were recorded, with the last answer repeated once they run out.
+    # Cassettes are meant to be shared, so credentials in form bodies and cookies set by the server are left out.
+
+    def __init__(self, filename, recording):
+        self.filename = filename
+        self.recording = recording
+        self.lock = threading.Lock()
+        self.interactions = []
+        self.played = defaultdict(int)	# (method, url, body) -> times replayed
+        if not recording:
+            with open(filename, 'rt') as h:
+                self.interactions = json.load(h)
+
+    def key(self, request):
+        body = request.body or ''
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if body and 'form-urlencoded' in request.headers.get('Content-Type', ''):
+            body = urlencode([(k, k in REDACT and 'REDACTED' or v) for (k, v) in parse_qsl(body, True)])
+        return (request.method, request.url, body)
+
+    def record(self, request, response):
+        (method, url, body) = self.key(request)
+        content = response.content
+        try:
+            content = { 'text': content.decode('utf-8') }
+        except UnicodeDecodeError:
+            content = { 'base64': base64.b64encode(content) }
+        headers = dict([(k, v) for (k, v) in response.headers.items() if k.lower() not in ['content-encoding', 'content-length', 'transfer-encoding', 'set-cookie']])
+        interaction = {
+            'request': { 'method': method, 'url': url, 'body': base64.b64encode(body) },
+            'response': dict(content, status=response.status_code, reason=response.reason, headers=headers),
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+            self.save()
+
+    def play(self, request):
+        (method, url, body) = self.key(request)
+        body = base64.b64encode(body)
+        with self.lock:
+            matches = [x['response'] for x in self.interactions if x['request']['method'] == method and x['request']['url'] == url and x['request']['body'] == body]
+            if not matches:
+                raise requests.exceptions.ConnectionError('Not in cassette: %s %s' % (method, url), request=request)
+            i = self.played[(method, url, body)]
+            self.played[(method, url, body)] += 1
+        recorded = matches[min(i, len(matches) - 1)]
+
+        response = requests.Response()
+        response.status_code = recorded['status']
+        response.reason = recorded['reason']
+        response.headers = CaseInsensitiveDict(recorded['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        if 'text' in recorded:
+            response._content = recorded['text'].encode('utf-8')
+        else:
+            response._content = base64.b64decode(recorded['base64'])
+        response._content_consumed = True
+        response.raw = BytesIO(response._content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def save(self):
+        # Write atomically
+        with open(self.filename + '.tmp', 'wt') as h:
+            json.dump(self.interactions, h, indent=1)
+        if exists(self.filename):
+            unlink(self.filename)	# Windows can't rename over an existing file
+        rename(self.filename + '.tmp', self.filename)
+
+
+class Transport(HTTPAdapter):
+
+    # Adapter shared by all Sessions, so that they share its connection pools. There's one that retries and one
+    # that doesn't, which share the cassette and metrics.
+
+    def __init__(self, max_retries=RETRY, parent=None):
+        HTTPAdapter.__init__(self, pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, max_retries=max_retries)
+        self.cassette = None
+        if parent:
+            (self.lock, self.metrics) = (parent.lock, parent.metrics)
+        else:
+            self.lock = threading.Lock()
+            self.metrics = defaultdict(lambda: { 'requests': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0, 'wire': 0 })	# host -> totals
+
+    def send(self, request, **kwargs):
+        host = urlsplit(request.url).netloc
+        start = time()
+        try:
+            if self.cassette and not self.cassette.recording:
+                response = self.cassette.play(request)
+                wire = len(response.content)
+            else:
+                response = HTTPAdapter.send(self, request, **kwargs)
+                response.content	# read it all now so that we can measure it and the connection goes back in the pool
+                wire = getattr(response.raw, 'tell', lambda: len(response.content))()	# before decompression
+                if self.cassette:
+                    self.cassette.record(request, response)
+        except:
+            with self.lock:
+                self.metrics[host]['requests'] += 1
+                self.metrics[host]['errors'] += 1
+                self.metrics[host]['seconds'] += time() - start
+            raise
+
+        with self.lock:
+            metrics = self.metrics[host]
+            metrics['requests'] += 1
+            metrics['errors'] += response.status_code >= 400 and 1 or 0
+            metrics['seconds'] += time() - start
+            metrics['bytes'] += len(response.content)
+            metrics['wire'] += wire
+        return response
+
+    def connections(self):
+        # host:port -> number of connections opened
+        pools = self.poolmanager.pools
+        return dict([('%s:%s' % (pools[key].host, pools[key].port), pools[key].num_connections) for key in pools.keys()])
+
+
+class Session(requests.Session):
+
+    # A requests Session that goes through the shared Transport and has a default timeout.
+    # Use one of these (rather than the shared one below) when you need your own cookies or headers.
+    # Pass retries=False for servers where every request counts against a rate limit, so that nothing is re-sent
+    # behind the caller's back.
+
+    def __init__(self, retries=True):
+        requests.Session.__init__(self)
+        self.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.mount('http://', retries and transport or noretry)
+        self.mount('https://', retries and transport or noretry)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', TIMEOUT)
+        return requests.Session.request(self, method, url, **kwargs)
+
+
+def record(filename):
+    # Record all subsequent interactions to a cassette file
+    transport.cassette = noretry.cassette = Cassette(filename, True)
+
+def replay(filename):
+    # Answer all subsequent requests from a cassette file, without touching the network
+    transport.cassette = noretry.cassette = Cassette(filename, False)
+
+def metrics():
+    # host -> { 'requests', 'errors', 'seconds', 'bytes' (after decompression), 'wire' (before), 'connections' }
+    with transport.lock:
+        result = dict([(host, dict(x)) for (host, x) in transport.metrics.items()])
+    for adapter in [transport, noretry]:
+        for (host, count) in adapter.connections().iteritems():
+            for key in [host, host.rsplit(':', 1)[0]]:	# netloc only includes the port if it's not the default
+                if key in result:
+                    result[key]['connections'] = result[key].get('connections', 0) + count
+    return result
+
+
+transport = Transport()
+noretry = Transport(0, transport)
+
+# For callers that don't need their own cookies or headers. requests' Sessions can be shared between threads
+# so long as their cookies and headers aren't changed, so this one refuses all cookies.
+session = Session()
+session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+def get(url, **kwargs):
+    return session.get(url, **kwargs)
+
+def post(url, data=None, **kwargs):
+    return session.post(url, data=data, **kwargs)
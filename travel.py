@@ -0,0 +1,399 @@
+#!/usr/bin/python
+#
+# Travel history, backfilled from the E:D client's netLogs
+#
+
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from heapq import merge
+import json
+from math import sqrt
+import mmap
+import multiprocessing
+from os import listdir, rename, stat, unlink
+from os.path import exists, join
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    import msvcrt	# Windows
+    fcntl = None
+
+if __debug__:
+    from traceback import print_exc
+
+from config import config
+import netlog
+
+
+HISTORY = 'travel.tsv'	# UTC time, system, x, y, z - sorted by time
+INDEX   = 'travel.json'	# netLog filename -> [size, mtime, first time, last time]
+JOURNAL = 'travel.bin'	# Journal records, oldest first
+JOURNALINDEX = 'travel.idx'	# Journal header and per-day index
+SYSTEMS = 'travel.sys'	# Journal's interned system names, one per line - the line number is the id
+LOCK    = 'travel.lock'	# Held while using the above, since the app and a backfill from the command line may both write
+
+FLAG_BACKFILLED = 1	# recovered from an old netLog rather than seen as it happened
+
+Visit = namedtuple('Visit', ['time', 'system', 'coordinates', 'flags'])	# system is unicode
+
+
+def _unicode(system):
+    # System names in netLogs and our files are UTF-8
+    return isinstance(system, str) and system.decode('utf-8') or system
+
+
+def index_file(filename):
+    # Returns [(time, system, x, y, z)] for all the jumps in a netLog, oldest first.
+    # Runs in a worker process.
+    history = []
+    try:
+        clock = netlog.LogClock(filename)
+        tail = netlog.LogTail(filename)
+        try:
+            for (record, offset) in tail.read():
+                if isinstance(record, netlog.Jump):
+                    history.append((clock(record.time), record.system) + record.coordinates)
+        finally:
+            tail.close()
+    except:
+        if __debug__: print_exc()
+    return history
+
+
+def load_index():
+    try:
+        with open(join(config.app_dir, INDEX), 'rt') as h:
+            return json.load(h)
+    except:
+        return {}
+
+def load_history():
+    history = []
+    try:
+        with open(join(config.app_dir, HISTORY), 'r') as h:
+            for line in h:
+                (visited, system, x, y, z) = line.rstrip('\n').split('\t')
+                history.append((int(visited), system, float(x), float(y), float(z)))
+    except IOError:
+        pass
+    return history
+
+def lock(h):
+    # Blocks until we have an exclusive lock on the open file h
+    if fcntl:
+        fcntl.lockf(h, fcntl.LOCK_EX)
+    else:
+        h.seek(0)
+        while True:
+            try:
+                msvcrt.locking(h.fileno(), msvcrt.LK_LOCK, 1)	# gives up after 10s
+                return
+            except IOError:
+                pass
+
+def unlock(h):
+    if fcntl:
+        fcntl.lockf(h, fcntl.LOCK_UN)
+    else:
+        h.seek(0)
+        msvcrt.locking(h.fileno(), msvcrt.LK_UNLCK, 1)
+
+def save(filename, write):
+    # Write atomically
+    filename = join(config.app_dir, filename)
+    with open(filename + '.tmp', 'wb') as h:
+        write(h)
+    if exists(filename):
+        unlink(filename)	# Windows can't rename over an existing file
+    rename(filename + '.tmp', filename)
+
+
+def backfill(logdir, processes=None):
+    # Index every netLog in logdir that has changed since last time. Returns the number of files indexed.
+    index = load_index()
+    todo = []
+    for name in sorted([x for x in listdir(logdir) if x.startswith('netLog.')]):
+        info = stat(join(logdir, name))
+        if index.get(name, [None, None])[:2] != [info.st_size, info.st_mtime]:
+            todo.append((name, info))
+    if not todo:
+        return 0
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(index_file, [join(logdir, name) for (name, info) in todo], chunksize=1)	# one file at a time
+    finally:
+        pool.close()
+        pool.join()
+
+    # A netLog only ever grows and netLogs don't overlap in time, so drop whatever we had in the time range of each
+    # file that changed and replace with its new contents
+    with journal.locked():
+        history = load_history()
+        index = load_index()	# again, in case another backfill finished while we were indexing
+        for (name, info) in todo:
+            if name in index:
+                (size, mtime, first, last) = index[name]
+                history = [x for x in history if not first <= x[0] <= last]
+        for ((name, info), new) in zip(todo, results):
+            index[name] = [info.st_size, info.st_mtime, new and new[0][0] or 0, new and new[-1][0] or -1]
+        history = list(merge(history, *[sorted(x) for x in results]))
+
+        save(HISTORY, lambda h: h.writelines(['%d\t%s\t%r\t%r\t%r\n' % x for x in history]))
+        save(INDEX, lambda h: json.dump(index, h))
+        journal.merge(history)
+    return len(todo)
+
+
+class Journal:
+
+    # Every jump, as fixed-width records in time order so that time-range and "last N" queries are a binary
+    # search over the memory-mapped file. The sidecar index holds a header with the record count and total
+    # distance, followed by one entry per UTC day holding the day's first record and distance travelled, so
+    # summaries come from the index and never need to read the records. Appending a jump updates both in
+    # place. The header's record count is authoritative - anything beyond it was left by a crash and is ignored.
+    # Other processes may change the files, so everything is done holding the lock file, and the files are reopened
+    # if they've changed since we last looked.
+
+    RECORD = struct.Struct('<IIfffI')	# time, system id, x, y, z, flags
+    HEADER = struct.Struct('<4sId')	# magic, record count, total distance in ly
+    DAY    = struct.Struct('<IId')	# day number since the epoch, first record, distance in ly
+    MAGIC  = 'EDTJ'
+
+    def __init__(self):
+        self.h = None	# journal and index are opened on first use
+        self.threadlock = threading.RLock()
+        self.lockh = None
+        self.lockdepth = 0
+        self.stamps = None	# identity and size of our files as we last left them
+
+    @contextmanager
+    def locked(self):
+        # Hold the lock file, re-entrantly, and pick up any changes that other processes have made
+        with self.threadlock:
+            if not self.lockdepth:
+                self.lockh = open(join(config.app_dir, LOCK), 'a+b')
+                lock(self.lockh)
+            self.lockdepth += 1
+            try:
+                if self.lockdepth == 1:
+                    if self.h and self.stamp() != self.stamps:
+                        self.close()
+                    self.open()
+                yield
+            finally:
+                self.lockdepth -= 1
+                if not self.lockdepth:
+                    unlock(self.lockh)
+                    self.lockh.close()
+                    self.lockh = None
+
+    def stamp(self):
+        # Changes when another process appends to or rebuilds the journal. st_ino is always 0 on Windows.
+        result = []
+        for filename in [self.filename, self.indexfilename, self.systemsfilename]:
+            try:
+                info = stat(filename)
+                result.append((info.st_ino, info.st_size))
+            except OSError:
+                result.append(None)
+        return result
+
+    def open(self):
+        if self.h:
+            return
+        self.filename = join(config.app_dir, JOURNAL)
+        self.indexfilename = join(config.app_dir, JOURNALINDEX)
+        self.systemsfilename = join(config.app_dir, SYSTEMS)
+
+        self.names = []
+        try:
+            with open(self.systemsfilename, 'r') as h:
+                self.names = [x.rstrip('\n').decode('utf-8') for x in h]
+        except IOError:
+            pass
+        self.ids = dict([(name, i) for (i, name) in enumerate(self.names)])
+
+        self.count = 0
+        self.distance = 0.0
+        self.days = []	# [day], for bisection
+        self.firsts = []	# [first record of day]
+        self.daydistances = []	# [distance travelled on day]
+        try:
+            with open(self.indexfilename, 'rb') as h:
+                (magic, self.count, self.distance) = self.HEADER.unpack(h.read(self.HEADER.size))
+                assert magic == self.MAGIC
+                data = h.read()
+            for i in range(0, len(data) - self.DAY.size + 1, self.DAY.size):
+                (day, first, distance) = self.DAY.unpack_from(data, i)
+                if first >= self.count:
+                    break
+                self.days.append(day)
+                self.firsts.append(first)
+                self.daydistances.append(distance)
+        except:
+            self.count = 0
+            self.distance = 0.0
+
+        self.h = open(self.filename, exists(self.filename) and 'r+b' or 'w+b')
+        self.h.truncate(self.count * self.RECORD.size)
+        self.indexh = open(self.indexfilename, exists(self.indexfilename) and 'r+b' or 'w+b')
+        self.indexh.truncate(self.HEADER.size + len(self.days) * self.DAY.size)
+        self.logmap = None
+        self.last = self.count and self.record(self.count - 1) or None
+        self.stamps = self.stamp()
+
+    def close(self):
+        if self.h:
+            if self.logmap:
+                self.logmap.close()
+            self.h.close()
+            self.indexh.close()
+            self.h = None
+            self.stamps = None
+
+    def append(self, timestamp, system, coordinates, flags=0):
+        # Adds a jump. Repeats of the last system, e.g. on changing game mode, and anything older than the last
+        # jump are ignored. Returns True if added.
+        with self.locked():
+            return self._append(timestamp, system, coordinates, flags)
+
+    def _append(self, timestamp, system, coordinates, flags):
+        system = _unicode(system)
+        timestamp = int(timestamp)
+        if self.last and (timestamp < self.last[0] or system == self.names[self.last[1]]):
+            return False
+
+        if system not in self.ids:
+            with open(self.systemsfilename, 'a') as h:
+                h.write(system.encode('utf-8') + '\n')
+            self.ids[system] = len(self.names)
+            self.names.append(system)
+
+        packed = self.RECORD.pack(timestamp, self.ids[system], coordinates[0], coordinates[1], coordinates[2], flags)
+        record = self.RECORD.unpack(packed)	# coordinates as rounded to float32
+        self.h.seek(self.count * self.RECORD.size)
+        self.h.write(packed)
+        self.h.flush()
+
+        distance = self.last and sqrt(sum([(a - b) ** 2 for (a, b) in zip(record[2:5], self.last[2:5])])) or 0.0
+        day = timestamp // 86400
+        if not self.days or self.days[-1] != day:
+            self.days.append(day)
+            self.firsts.append(self.count)
+            self.daydistances.append(0.0)
+        self.daydistances[-1] += distance
+        self.count += 1
+        self.distance += distance
+        self.last = record
+
+        self.indexh.seek(self.HEADER.size + (len(self.days) - 1) * self.DAY.size)
+        self.indexh.write(self.DAY.pack(day, self.firsts[-1], self.daydistances[-1]))
+        self.indexh.seek(0)
+        self.indexh.write(self.HEADER.pack(self.MAGIC, self.count, self.distance))	# commit
+        self.indexh.flush()
+        self.stamps = self.stamp()
+        return True
+
+    def merge(self, history):
+        # Rebuild to include [(time, system, x, y, z)], e.g. from backfill(), keeping what we already have.
+        with self.locked():
+            ours = [(x.time, x.system, x.coordinates, x.flags) for x in self.range()]
+            seen = set([(x[0], x[1]) for x in ours])
+            theirs = [(x[0], _unicode(x[1]), x[2:5], FLAG_BACKFILLED) for x in history if (x[0], _unicode(x[1])) not in seen]
+            if not theirs:
+                return
+            self.close()
+            for filename in [self.filename, self.indexfilename]:
+                unlink(filename)
+            self.open()
+            for visit in merge(ours, theirs):
+                self._append(*visit)
+
+    def mapped(self):
+        # The records, memory-mapped
+        if not self.logmap or len(self.logmap) < self.count * self.RECORD.size:
+            if self.logmap:
+                self.logmap.close()
+            self.logmap = mmap.mmap(self.h.fileno(), self.count * self.RECORD.size, access=mmap.ACCESS_READ)
+        return self.logmap
+
+    def record(self, i):
+        return self.RECORD.unpack_from(self.mapped(), i * self.RECORD.size)
+
+    def visits(self, start, end):
+        # Records [start:end] as Visits
+        if start >= end:
+            return []
+        logmap = self.mapped()
+        return [Visit(x[0], self.names[x[1]], x[2:5], x[5]) for x in
+                [self.RECORD.unpack_from(logmap, i * self.RECORD.size) for i in range(start, end)]]
+
+    def bisect(self, timestamp):
+        # Index of the first record at or after timestamp
+        day = timestamp // 86400
+        i = bisect_left(self.days, day)
+        if i >= len(self.days):
+            return self.count
+        elif self.days[i] != day:
+            return self.firsts[i]
+        lo = self.firsts[i]
+        hi = i + 1 < len(self.firsts) and self.firsts[i+1] or self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, start=0, end=None):
+        # Visits with start <= time < end
+        with self.locked():
+            return self.visits(self.bisect(start), self.bisect(end is None and 0xffffffff or end))
+
+    def latest(self, n):
+        # The last n Visits
+        with self.locked():
+            return self.visits(max(0, self.count - n), self.count)
+
+    def summary(self):
+        # (jumps, total distance in ly)
+        with self.locked():
+            return (self.count, self.distance)
+
+    def daily(self, start=0, end=None):
+        # [(UTC midnight, jumps, distance in ly)] for each day with start <= midnight < end on which we jumped
+        with self.locked():
+            lo = bisect_left(self.days, start // 86400)
+            hi = bisect_left(self.days, end is None and 0xffffffff or (end + 86399) // 86400)
+            return [(self.days[i] * 86400, (i + 1 < len(self.firsts) and self.firsts[i+1] or self.count) - self.firsts[i], self.daydistances[i]) for i in range(lo, hi)]
+
+
+# singleton
+journal = Journal()
+
+
+# Backfill from the command line
+if __name__ == "__main__":
+    import argparse
+    from time import time
+    from monitor import monitor
+
+    parser = argparse.ArgumentParser(description='Index jumps from E:D netLogs into the local travel history.')
+    parser.add_argument('-j', metavar='N', type=int, help='use N worker processes (default one per CPU)')
+    parser.add_argument('logdir', nargs='?', help='E:D client\'s Logs directory (default as configured)')
+    args = parser.parse_args()
+
+    logdir = args.logdir or config.get('logdir') or monitor.logdir
+    if not logdir:
+        parser.error('Can\'t find the E:D client\'s Logs directory')
+    start = time()
+    count = backfill(logdir, args.j)
+    print 'Indexed %d files in %.1fs' % (count, time() - start)
+    (jumps, distance) = journal.summary()
+    print '%d jumps, %.0f ly' % (jumps, distance)